@@ -1,18 +1,35 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
-import json
+import bisect
+import math
+import mmap
+import multiprocessing
+import os
+import queue
+import re
 import sys
 import threading
 import signal
+import struct
 import time
+import uuid
+import zlib
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from io import BytesIO
+from multiprocessing import shared_memory
 
 import mss
-from mss import tools
 import numpy as np
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, Response
-import uvicorn
+from PIL import Image
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # optional: enables the zstd /ws codec
 
 
 # ---------- CLI ARGUMENTS ----------
@@ -67,7 +84,89 @@ parser.add_argument(
     "--fps",
     type=int,
     default=15,
-    help="Target frames per second (default: 15).",
+    help="Target frames per second: the default and the maximum for each /ws client's ?fps= (default: 15).",
+)
+parser.add_argument(
+    "--idle-fps",
+    type=float,
+    default=2.0,
+    help="Capture rate the loop backs off to while the screen is unchanged (default: 2).",
+)
+parser.add_argument(
+    "--tile-size",
+    type=int,
+    default=64,
+    help="Tile edge in pixels for the /ws delta codec (default: 64).",
+)
+parser.add_argument(
+    "--keyframe-interval",
+    type=float,
+    default=2.0,
+    help="Seconds between forced delta keyframes so late joiners resync (default: 2.0).",
+)
+parser.add_argument(
+    "--encode-workers",
+    type=int,
+    default=2,
+    help="Threads used to encode frames off the event loop (default: 2).",
+)
+parser.add_argument(
+    "--encode-processes",
+    type=int,
+    default=0,
+    help="Worker processes for PNG/JPEG/WebP encoding; frames reach them through shared memory "
+    "(default: 0, encode in the --encode-workers threads).",
+)
+parser.add_argument(
+    "--history-mb",
+    type=float,
+    default=64.0,
+    help="Memory budget in MB for the recent-frame history served by /frames (0 disables, default: 64).",
+)
+parser.add_argument(
+    "--history-seconds",
+    type=float,
+    default=30.0,
+    help="Maximum age of frames kept in the history (default: 30).",
+)
+parser.add_argument(
+    "--record",
+    metavar="DIR",
+    default=None,
+    help="Record every captured frame to segment files in DIR (keyframes + compressed deltas), "
+    "replayable via /replay. Implies continuous capture.",
+)
+parser.add_argument(
+    "--record-max-mb",
+    type=float,
+    default=2048.0,
+    help="Disk budget for --record; the oldest segments are deleted beyond it (default: 2048).",
+)
+parser.add_argument(
+    "--record-segment-mb",
+    type=float,
+    default=64.0,
+    help="Size at which --record starts a new segment file (default: 64).",
+)
+parser.add_argument(
+    "--region",
+    action="append",
+    default=[],
+    metavar="NAME=LEFT,TOP,WIDTH,HEIGHT",
+    help="Named region in screen coordinates, served at /regions/NAME/... (repeatable). "
+    "All regions and the main region come from one grab of their bounding box.",
+)
+parser.add_argument(
+    "--source",
+    choices=["mss", "synthetic"],
+    default="mss",
+    help="Frame source: the real screen (mss) or a generated test pattern for headless runs (default: mss).",
+)
+parser.add_argument(
+    "--pattern",
+    choices=["moving", "static"],
+    default="moving",
+    help="Synthetic source pattern; its size comes from --width/--height (default 1280x720).",
 )
 parser.add_argument(
     "--background",
@@ -75,542 +174,1827 @@ parser.add_argument(
     help="Capture continuously in the background so /snapshot.png works without a client.",
 )
 
-args = parser.parse_args()
-
-MONITOR_ID = args.monitor
-REL_TOP = args.top
-REL_LEFT = args.left
-REQ_WIDTH = args.width
-REQ_HEIGHT = args.height
-TARGET_FPS = max(1, args.fps)
-BACKGROUND_CAPTURE = args.background
-USE_OVERLAY = MONITOR_ID == -1
-
-print(
-    f"[config] monitor={MONITOR_ID}, top={REL_TOP}, left={REL_LEFT}, "
-    f"width={REQ_WIDTH}, height={REQ_HEIGHT}, fps={TARGET_FPS}, "
-    f"host={args.host}, port={args.port}"
-)
-if BACKGROUND_CAPTURE:
-    print("[config] background capture enabled")
-
-if USE_OVERLAY:
-    print("[config] monitor=-1 uses a transparent overlay window")
-
-
-# ---------- FASTAPI APP ----------
-
-app = FastAPI()
-frame_lock = threading.Lock()
-latest_rgba = None
-latest_png = None
-latest_size = (0, 0)
-last_capture_ts = 0.0
-
-overlay_lock = threading.Lock()
-overlay_region = None
-overlay_ready = threading.Event()
-
-
-@app.get("/")
-async def index():
-    """
-    Returns HTML page with a <canvas> that uses WebGL.
-    It connects to /ws and draws the raw RGBA frames as a texture.
-    """
-    html = r"""
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="utf-8">
-    <title>Local Screen Region Viewer (WebGL)</title>
-    <style>
-        body {
-            margin: 0;
-            background: #000;
-            display: flex;
-            height: 100vh;
-            overflow: hidden;
-        }
-        #canvas-wrapper {
-            flex: 1;
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            background: #000;
-        }
-        canvas {
-            background: #000;
-            max-width: 100%;
-            max-height: 100%;
-        }
-    </style>
-</head>
-<body>
-<div id="canvas-wrapper">
-    <canvas id="screenCanvas"></canvas>
-</div>
-
-<script>
-(function () {
-    const canvas = document.getElementById("screenCanvas");
-
-    // ---------- WebGL SETUP ----------
-
-    /** @type {WebGLRenderingContext} */
-    const gl = canvas.getContext("webgl", { preserveDrawingBuffer: true });
-    if (!gl) {
-        console.error("WebGL not supported in this environment.");
-        return;
-    }
-
-    function resizeCanvasToDisplaySize() {
-        if (!initialized || frameWidth === 0 || frameHeight === 0) {
-            return;
-        }
 
-        const parent = canvas.parentElement;
-        const containerWidth = parent.clientWidth;
-        const containerHeight = parent.clientHeight;
-
-        // Calculate aspect ratios
-        const sourceAspect = frameWidth / frameHeight;
-        const containerAspect = containerWidth / containerHeight;
-
-        let canvasWidth, canvasHeight;
-
-        // Fit the canvas within the container while maintaining aspect ratio
-        if (sourceAspect > containerAspect) {
-            // Source is wider than container - fit to width
-            canvasWidth = containerWidth;
-            canvasHeight = containerWidth / sourceAspect;
-        } else {
-            // Source is taller than container - fit to height
-            canvasHeight = containerHeight;
-            canvasWidth = containerHeight * sourceAspect;
-        }
+MIN_CLIENT_FPS = 0.1
+SNAPSHOT_TIMEOUT = 5.0
+MAX_WAIT_TIMEOUT = 120.0
+IDLE_AFTER = 1.0  # seconds without a change before the capture rate backs off
+
+
+class Settings:
+    """Parsed options (CLI or ScreenStreamer) resolved into one streamer's settings."""
+
+    def __init__(self, options: argparse.Namespace):
+        self.options = options
+        self.monitor = options.monitor
+        self.rel_top = options.top
+        self.rel_left = options.left
+        self.req_width = options.width
+        self.req_height = options.height
+        self.target_fps = max(1, options.fps)
+        self.idle_fps = min(self.target_fps, max(0.1, options.idle_fps))
+        self.background = options.background
+        self.tile_size = max(8, options.tile_size)
+        self.keyframe_interval = max(0.0, options.keyframe_interval)
+        self.encode_workers = max(1, options.encode_workers)
+        self.encode_processes = max(0, options.encode_processes)
+        self.history_bytes = max(0, int(options.history_mb * 1024 * 1024))
+        self.history_seconds = max(0.0, options.history_seconds)
+        self.record_dir = options.record
+        self.record_max_bytes = max(1, int(options.record_max_mb * 1024 * 1024))
+        self.record_segment_bytes = max(
+            1024 * 1024, min(int(options.record_segment_mb * 1024 * 1024), self.record_max_bytes // 4)
+        )
+        self.source = options.source
+        self.pattern = options.pattern
+        self.use_overlay = self.monitor == -1 and self.source == "mss"
+
+    def print_config(self):
+        options = self.options
+        print(
+            f"[config] monitor={self.monitor}, top={self.rel_top}, left={self.rel_left}, "
+            f"width={self.req_width}, height={self.req_height}, fps={self.target_fps}, idle_fps={self.idle_fps:g}, "
+            f"host={options.host}, port={options.port}"
+        )
+        print(f"[config] delta tile={self.tile_size}px, keyframe every {self.keyframe_interval}s")
+        if self.encode_processes:
+            print(f"[config] {self.encode_processes} encode processes (shared-memory frame handoff)")
+        if self.history_bytes:
+            print(f"[config] frame history: {options.history_mb:g} MB, up to {self.history_seconds:g}s")
+        if self.background:
+            print("[config] background capture enabled")
+        if self.record_dir:
+            print(f"[config] recording to {self.record_dir} (up to {options.record_max_mb:g} MB)")
+
+        if self.use_overlay:
+            print("[config] monitor=-1 uses a transparent overlay window")
+        if self.source == "synthetic":
+            print(f"[config] synthetic {self.pattern} source, no screen capture")
+
+
+async def paced_frames(channel: "FrameChannel", fps: float, *stops: asyncio.Future):
+    """
+    Yield the channel's frames at most `fps` times per second: the first
+    one at once, then the newest frame at each deadline (or every frame
+    as published when fps is not below the capture rate). Deadlines sit on
+    a fixed grid of the monotonic clock (multiples of 1/fps), so the rate
+    does not drift, missed slots are skipped rather than bunched up, and
+    consumers at the same fps pick the same frames (sharing encodes).
+    Between frames it sleeps until the capture thread publishes, clears or
+    interrupts the channel; nothing polls. Ends on shutdown, when the
+    region is removed, when capture fails or when any of `stops` completes.
+    """
+    hub = channel._hub
+    loop = asyncio.get_running_loop()
+    interval = 1.0 / fps
+    waits = stops
+    due = loop.time()
+    seq = 0
+
+    def ended() -> bool:
+        return hub.streamer.exiting() or getattr(channel, "closed", False) or any(stop.done() for stop in stops)
+
+    while not ended():
+        waiter = channel.frame_future(seq)
+        await asyncio.wait((waiter, *waits), return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        if ended():
+            return
+        frame = channel.latest()
+        if frame is None:
+            if hub.error:
+                return
+            continue
+        if frame.seq <= seq:
+            continue
+        # At or above the capture rate every frame is due: no added latency.
+        delay = due - loop.time() if fps < hub.rate() else 0
+        if delay > 0:
+            # Decimate: hold until the next slot, then take the newest frame.
+            if waits:
+                await asyncio.wait(waits, timeout=delay)
+            else:
+                await asyncio.sleep(delay)
+            continue
+        seq = frame.seq
+        yield frame
+        now = loop.time()
+        due = (math.floor(now / interval) + 1) * interval
+        if due - now < interval / 2:  # only after the first frame, which is not on the grid
+            due += interval
+
+
+class FrameSource(ABC):
+    """
+    Capture backend used by the capture thread. Used as a context manager;
+    `region()` returns the area to grab (raising ValueError while it is not
+    known yet) and `grab(region)` returns `(raw, width, height)` where raw
+    is a fresh BGRA bytearray that the source never touches again.
+    """
 
-        if (canvas.width !== canvasWidth || canvas.height !== canvasHeight) {
-            canvas.width = canvasWidth;
-            canvas.height = canvasHeight;
-            gl.viewport(0, 0, canvas.width, canvas.height);
-        }
-    }
-    window.addEventListener("resize", resizeCanvasToDisplaySize);
+    name = "source"
 
-    const vertexShaderSource = `
-        attribute vec2 a_position;
-        attribute vec2 a_texCoord;
-        varying vec2 v_texCoord;
+    def __enter__(self):
+        return self
 
-        void main() {
-            gl_Position = vec4(a_position, 0.0, 1.0);
-            v_texCoord = a_texCoord;
-        }
-    `;
+    def __exit__(self, *exc):
+        return False
 
-    const fragmentShaderSource = `
-        precision mediump float;
-        varying vec2 v_texCoord;
-        uniform sampler2D u_texture;
+    @abstractmethod
+    def region(self) -> dict:
+        ...
 
-        void main() {
-            gl_FragColor = texture2D(u_texture, v_texCoord);
-        }
-    `;
-
-    function createShader(gl, type, source) {
-        const shader = gl.createShader(type);
-        gl.shaderSource(shader, source);
-        gl.compileShader(shader);
-        if (!gl.getShaderParameter(shader, gl.COMPILE_STATUS)) {
-            console.error("Shader compile failed:", gl.getShaderInfoLog(shader));
-            gl.deleteShader(shader);
-            return null;
-        }
-        return shader;
-    }
-
-    function createProgram(gl, vsSource, fsSource) {
-        const vs = createShader(gl, gl.VERTEX_SHADER, vsSource);
-        const fs = createShader(gl, gl.FRAGMENT_SHADER, fsSource);
-        const program = gl.createProgram();
-        gl.attachShader(program, vs);
-        gl.attachShader(program, fs);
-        gl.linkProgram(program);
-        if (!gl.getProgramParameter(program, gl.LINK_STATUS)) {
-            console.error("Program link failed:", gl.getProgramInfoLog(program));
-            gl.deleteProgram(program);
-            return null;
-        }
-        return program;
-    }
-
-    const program = createProgram(gl, vertexShaderSource, fragmentShaderSource);
-    gl.useProgram(program);
-
-    const positionLocation = gl.getAttribLocation(program, "a_position");
-    const texCoordLocation = gl.getAttribLocation(program, "a_texCoord");
-    const textureLocation  = gl.getUniformLocation(program, "u_texture");
-
-    // Full-screen quad
-    const positionBuffer = gl.createBuffer();
-    gl.bindBuffer(gl.ARRAY_BUFFER, positionBuffer);
-    const positions = new Float32Array([
-        -1, -1,
-         1, -1,
-        -1,  1,
-         1,  1,
-    ]);
-    gl.bufferData(gl.ARRAY_BUFFER, positions, gl.STATIC_DRAW);
-
-    // Texture coords
-    const texCoordBuffer = gl.createBuffer();
-    gl.bindBuffer(gl.ARRAY_BUFFER, texCoordBuffer);
-    const texCoords = new Float32Array([
-        0, 1,
-        1, 1,
-        0, 0,
-        1, 0,
-    ]);
-    gl.bufferData(gl.ARRAY_BUFFER, texCoords, gl.STATIC_DRAW);
-
-    // Setup attributes
-    gl.bindBuffer(gl.ARRAY_BUFFER, positionBuffer);
-    gl.enableVertexAttribArray(positionLocation);
-    gl.vertexAttribPointer(positionLocation, 2, gl.FLOAT, false, 0, 0);
-
-    gl.bindBuffer(gl.ARRAY_BUFFER, texCoordBuffer);
-    gl.enableVertexAttribArray(texCoordLocation);
-    gl.vertexAttribPointer(texCoordLocation, 2, gl.FLOAT, false, 0, 0);
-
-    // Texture
-    const texture = gl.createTexture();
-    gl.bindTexture(gl.TEXTURE_2D, texture);
-
-    gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_MIN_FILTER, gl.LINEAR);
-    gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_MAG_FILTER, gl.LINEAR);
-    gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_S, gl.CLAMP_TO_EDGE);
-    gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_T, gl.CLAMP_TO_EDGE);
-
-    gl.uniform1i(textureLocation, 0);
-
-    // ---------- WEBSOCKET / FRAME HANDLING ----------
-
-    let frameWidth = 0;
-    let frameHeight = 0;
-    let initialized = false;
-
-    const wsProtocol = (location.protocol === "https:") ? "wss" : "ws";
-    const wsUrl = wsProtocol + "://" + location.host + "/ws";
-    const ws = new WebSocket(wsUrl);
-    ws.binaryType = "arraybuffer";
-
-    ws.onopen = () => {
-        console.log("WebSocket connected, waiting for frames...");
-    };
-
-    ws.onclose = () => {
-        console.log("WebSocket disconnected. Refresh to reconnect.");
-    };
-
-    ws.onerror = (e) => {
-        console.error("WebSocket error:", e);
-    };
-
-    ws.onmessage = (event) => {
-        if (typeof event.data === "string") {
-            try {
-                const msg = JSON.parse(event.data);
-                if (msg.type === "init") {
-                    frameWidth = msg.width;
-                    frameHeight = msg.height;
-                    console.log(`Streaming ${frameWidth}x${frameHeight}`);
-                    initialized = true;
-                    resizeCanvasToDisplaySize();
-                } else if (msg.type === "error") {
-                    console.error("Server error:", msg.message);
-                }
-            } catch (err) {
-                console.error("Failed to parse JSON message:", err);
-            }
-            return;
+    @abstractmethod
+    def grab(self, region: dict) -> tuple[bytearray, int, int]:
+        ...
+
+
+class MssSource(FrameSource):
+    """The real screen through mss, honouring --monitor/--top/--left/... and the overlay."""
+
+    name = "mss"
+
+    def __init__(self, streamer: "ScreenStreamer"):
+        self.streamer = streamer
+
+    def __enter__(self):
+        self._sct = mss.mss()
+        return self
+
+    def __exit__(self, *exc):
+        self._sct.close()
+        return False
+
+    def region(self) -> dict:
+        streamer = self.streamer
+        settings = streamer.settings
+        if settings.use_overlay:
+            with streamer.overlay_lock:
+                region = streamer.overlay_region
+            if not region:
+                raise ValueError("Overlay region not ready")
+            return dict(region)
+
+        monitors = self._sct.monitors
+        if settings.monitor < 0 or settings.monitor >= len(monitors):
+            raise ValueError(
+                f"Invalid monitor_id {settings.monitor}, available: 0..{len(monitors)-1}"
+            )
+
+        mon = monitors[settings.monitor]
+
+        top = mon["top"] + settings.rel_top
+        left = mon["left"] + settings.rel_left
+        width = settings.req_width if settings.req_width is not None else (mon["width"] - settings.rel_left)
+        height = settings.req_height if settings.req_height is not None else (mon["height"] - settings.rel_top)
+
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Computed invalid region width={width}, height={height}")
+
+        return {
+            "top": top,
+            "left": left,
+            "width": width,
+            "height": height,
         }
 
-        if (!initialized) return;
+    def grab(self, region: dict) -> tuple[bytearray, int, int]:
+        shot = self._sct.grab(region)
+        return shot.raw, shot.width, shot.height
+
+
+class SyntheticSource(FrameSource):
+    """
+    Generated BGRA test pattern at any resolution, for headless runs and
+    benchmarks: a fixed colour gradient with, in the "moving" pattern, a
+    bright bar that advances on every grab (so every frame differs) and,
+    in the "static" pattern, no change at all.
+    """
 
-        const buffer = event.data;
-        const pixels = new Uint8Array(buffer);
+    name = "synthetic"
+
+    def __init__(self, width: int = 1280, height: int = 720, pattern: str = "moving"):
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Invalid synthetic size {width}x{height}")
+        self.width = width
+        self.height = height
+        self.pattern = pattern
+        self._count = 0
+        ys = np.linspace(0, 255, height, dtype=np.uint8)[:, None]
+        xs = np.linspace(0, 255, width, dtype=np.uint8)[None, :]
+        base = np.empty((height, width, 4), dtype=np.uint8)
+        base[..., 0] = xs
+        base[..., 1] = ys
+        base[..., 2] = (xs // 2 + ys // 2)
+        base[..., 3] = 255
+        self._base = base.tobytes()
+        self._bar = max(1, width // 32)
+        self._step = max(1, width // 120)
+
+    def region(self) -> dict:
+        return {"top": 0, "left": 0, "width": self.width, "height": self.height}
+
+    def grab(self, region: dict) -> tuple[bytearray, int, int]:
+        raw = bytearray(self._base)
+        if self.pattern == "moving":
+            pixels = np.frombuffer(raw, dtype=np.uint8).reshape(self.height, self.width, 4)
+            x = (self._count * self._step) % (self.width - self._bar + 1)
+            pixels[:, x:x + self._bar, :3] = 255
+            self._count += 1
+        if region and region != self.region():
+            # Areas outside the pattern (e.g. a region beyond it) read as black.
+            out = np.zeros((region["height"], region["width"], 4), dtype=np.uint8)
+            src = np.frombuffer(raw, dtype=np.uint8).reshape(self.height, self.width, 4)
+            x0, y0 = max(0, region["left"]), max(0, region["top"])
+            x1 = min(self.width, region["left"] + region["width"])
+            y1 = min(self.height, region["top"] + region["height"])
+            if x1 > x0 and y1 > y0:
+                out[y0 - region["top"]:y1 - region["top"], x0 - region["left"]:x1 - region["left"]] = src[y0:y1, x0:x1]
+            return bytearray(out.tobytes()), region["width"], region["height"]
+        return raw, self.width, self.height
+
+
+@dataclass(frozen=True, eq=False)
+class Frame:
+    """
+    One published capture. `pixels` is a read-only (height, width, 4) BGRA
+    view over the buffer the frame source allocated for this grab; it is
+    never copied or reused, so consumers may hold it for as long as they need.
+    Cropped/downscaled variants share the seq and differ in `view`. Frames
+    of a named region carry its name in `channel` and have their own seq;
+    their pixels (and the main frame's, while regions exist) are strided
+    slices of one larger grab.
+    """
 
-        if (pixels.length !== frameWidth * frameHeight * 4) {
-            console.warn("Unexpected pixel data length:", pixels.length);
-            return;
+    seq: int
+    ts: float
+    width: int
+    height: int
+    pixels: np.ndarray = field(repr=False)
+    view: tuple = ()  # (crop box, output size) when derived by frame_view()
+    channel: str = ""  # region name; "" is the main region
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return (self.width, self.height)
+
+
+class LatencyHistogram:
+    """Cumulative-bucket latency histogram in the Prometheus style."""
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = []
+        running = 0
+        for bound, n in zip(self.BUCKETS + (float("inf"),), counts):
+            running += n
+            cumulative.append((bound, running))
+        return {"buckets": cumulative, "sum": total, "count": count}
+
+
+class IntervalStats:
+    """Spacing of recent events (monotonic seconds) and its jitter against a target interval."""
+
+    def __init__(self, size: int = 120):
+        self._last = None
+        self._intervals = deque(maxlen=size)
+
+    def tick(self, now: float):
+        if self._last is not None:
+            self._intervals.append(now - self._last)
+        self._last = now
+
+    def snapshot(self, target: float | None = None) -> dict:
+        intervals = np.array(self._intervals)
+        if not intervals.size:
+            return {"samples": 0}
+        mean = float(intervals.mean())
+        result = {
+            "samples": int(intervals.size),
+            "mean_ms": round(mean * 1000.0, 3),
+            "stdev_ms": round(float(intervals.std()) * 1000.0, 3),
+            "p95_ms": round(float(np.percentile(intervals, 95)) * 1000.0, 3),
+            "fps": round(1.0 / mean, 3) if mean > 0 else None,
         }
+        if target:
+            deviation = np.abs(intervals - target)
+            result["p95_deviation_ms"] = round(float(np.percentile(deviation, 95)) * 1000.0, 3)
+        return result
 
-        gl.bindTexture(gl.TEXTURE_2D, texture);
-        gl.pixelStorei(gl.UNPACK_ALIGNMENT, 1);
-        gl.texImage2D(
-            gl.TEXTURE_2D,
-            0,
-            gl.RGBA,
-            frameWidth,
-            frameHeight,
-            0,
-            gl.RGBA,
-            gl.UNSIGNED_BYTE,
-            pixels
-        );
-
-        resizeCanvasToDisplaySize();
-        gl.viewport(0, 0, canvas.width, canvas.height);
-        gl.clearColor(0.0, 0.0, 0.0, 1.0);
-        gl.clear(gl.COLOR_BUFFER_BIT);
-        gl.drawArrays(gl.TRIANGLE_STRIP, 0, 4);
-    };
-
-    resizeCanvasToDisplaySize();
-})();
-</script>
-</body>
-</html>
-    """
-    return HTMLResponse(html)
-
-
-@app.websocket("/ws")
-async def websocket_endpoint(ws: WebSocket):
-    """
-    Each WebSocket connection gets its own capture loop.
-    - Capture only starts after the WebSocket is accepted.
-    - Loop stops cleanly when the client disconnects or refreshes.
-    """
-    await ws.accept()
-    print("[ws] client connected")
 
-    try:
-        if BACKGROUND_CAPTURE:
-            last_size = (0, 0)
-            while True:
-                if shutdown_flag.is_set() or (uvicorn_server is not None and uvicorn_server.should_exit):
-                    request_shutdown("server exit signaled")
-                    await ws.close(code=1001, reason="server shutdown")
-                    break
-
-                with frame_lock:
-                    rgba = latest_rgba
-                    width, height = latest_size
-
-                if rgba is None or width == 0 or height == 0:
-                    await asyncio.sleep(0.05)
-                    continue
-
-                if (width, height) != last_size:
-                    init_msg = {
-                        "type": "init",
-                        "width": width,
-                        "height": height,
-                    }
-                    await ws.send_text(json.dumps(init_msg))
-                    last_size = (width, height)
-                if last_size != (0, 0):
-                    break
-
-            frame_interval = 1.0 / TARGET_FPS
-            while True:
-                if shutdown_flag.is_set() or (uvicorn_server is not None and uvicorn_server.should_exit):
-                    request_shutdown("server exit signaled")
-                    await ws.close(code=1001, reason="server shutdown")
-                    break
-
-                start = asyncio.get_event_loop().time()
-                with frame_lock:
-                    rgba = latest_rgba
-                    width, height = latest_size
-                if (width, height) != last_size and width > 0 and height > 0:
-                    init_msg = {
-                        "type": "init",
-                        "width": width,
-                        "height": height,
-                    }
-                    await ws.send_text(json.dumps(init_msg))
-                    last_size = (width, height)
-                if last_size == (0, 0):
-                    await asyncio.sleep(0.05)
-                    continue
-                if rgba is not None:
-                    await ws.send_bytes(rgba)
-
-                elapsed = asyncio.get_event_loop().time() - start
-                sleep_time = frame_interval - elapsed
-                if sleep_time > 0:
-                    await asyncio.sleep(sleep_time)
-        else:
-            with mss.mss() as sct:
-                monitor_region = get_capture_region(sct)
-                print(f"[capture] Using region: {monitor_region} (monitor index {MONITOR_ID})")
-
-                # First frame for size
-                first_frame = sct.grab(monitor_region)
-                h = first_frame.height
-                w = first_frame.width
-
-                init_msg = {
-                    "type": "init",
-                    "width": w,
-                    "height": h,
-                }
-                await ws.send_text(json.dumps(init_msg))
-
-                frame_interval = 1.0 / TARGET_FPS
-
-                # ---- CAPTURE LOOP: ONLY WHILE THIS CLIENT IS CONNECTED ----
-                while True:
-                    if shutdown_flag.is_set() or (uvicorn_server is not None and uvicorn_server.should_exit):
-                        request_shutdown("server exit signaled")
-                        await ws.close(code=1001, reason="server shutdown")
-                        break
-
-                    start = asyncio.get_event_loop().time()
-
-                    if USE_OVERLAY:
+class Metrics:
+    """
+    Per-streamer counters behind /metrics: one latency histogram per
+    pipeline stage plus rolling capture/publish timestamps for achieved FPS.
+    """
+
+    STAGES = ("grab", "convert", "delta", "encode", "send", "record")
+
+    def __init__(self):
+        self.stages = {stage: LatencyHistogram() for stage in self.STAGES}
+        self.grab_times = deque(maxlen=64)
+        self.publish_times = deque(maxlen=64)
+        self.grab_intervals = IntervalStats()
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+
+    def observe(self, stage: str, seconds: float):
+        self.stages[stage].observe(seconds)
+
+    @staticmethod
+    def rate(times: deque) -> float:
+        stamps = list(times)
+        if len(stamps) < 2 or stamps[-1] - stamps[0] <= 0 or time.time() - stamps[-1] > 5.0:
+            return 0.0
+        return (len(stamps) - 1) / (stamps[-1] - stamps[0])
+
+
+def _resolve_waiter(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class FrameChannel:
+    """
+    Latest-frame publication for one stream of frames: the main region (the
+    hub itself) or a named region. Readers take latest(), block a thread in
+    wait_for_frame()/wait_for_change(), or await next_frame() on an event
+    loop; the capture thread publishes.
+
+    Event-loop waiters are futures resolved with call_soon_threadsafe on
+    every publish, clear (capture stopped or failed) and shutdown, so they
+    wake exactly when there is something to look at and never poll.
+    """
+
+    name = ""
+
+    def __init__(self, hub: "CaptureHub | None" = None):
+        self._hub = hub or self
+        self._cond = threading.Condition()
+        self._frame = None
+        self._parked = None  # last frame before capture stopped; see _publish()
+        self._seq = 0
+        self._waiters = []  # (loop, future) pairs, guarded by _cond
+
+    def _notify(self):
+        """Wake thread and event-loop waiters; call with _cond held."""
+        self._cond.notify_all()
+        for loop, future in self._waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve_waiter, future)
+            except RuntimeError:
+                pass  # loop already closed
+        self._waiters.clear()
+
+    def interrupt(self):
+        """Wake every waiter so it re-checks shutdown/closed state."""
+        with self._cond:
+            self._notify()
+
+    def _forget(self, future: asyncio.Future):
+        with self._cond:
+            self._waiters = [entry for entry in self._waiters if entry[1] is not future]
+
+    def frame_future(self, after_seq: int) -> asyncio.Future:
+        """
+        A future on the running loop that resolves once a frame newer than
+        after_seq is published or the channel is cleared or interrupted
+        (already resolved if such a frame exists). It carries no value:
+        look at latest() afterwards.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            if (self._frame is not None and self._frame.seq > after_seq) or self._hub.shutdown_flag.is_set():
+                future.set_result(None)
+            else:
+                self._waiters.append((loop, future))
+        future.add_done_callback(self._forget)
+        return future
+
+    async def next_frame(self, after_seq: int, timeout: float | None = None, urgent: bool = False) -> Frame | None:
+        """
+        Await a frame newer than after_seq; None on timeout, shutdown or
+        when capture stops. urgent keeps the capture loop at full rate
+        meanwhile, as wait_for_change() does.
+        """
+        hub = self._hub
+        if urgent:
+            with hub._cond:
+                hub._change_waiters += 1
+            hub._wake.set()
+        try:
+            try:
+                await asyncio.wait_for(self.frame_future(after_seq), timeout)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            if urgent:
+                with hub._cond:
+                    hub._change_waiters -= 1
+        frame = self.latest()
+        return frame if frame is not None and frame.seq > after_seq else None
+
+    def latest(self) -> Frame | None:
+        with self._cond:
+            return self._frame
+
+    def wait_for_frame(self, after_seq: int, timeout: float) -> Frame | None:
+        """Block until a frame newer than after_seq is published (or timeout)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._frame is None or self._frame.seq <= after_seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._hub._thread is None or self._hub.shutdown_flag.is_set():
+                    return None
+                self._cond.wait(remaining)
+            return self._frame
+
+    def wait_for_change(self, after_seq: int, timeout: float) -> Frame | None:
+        """Like wait_for_frame, but keeps the capture loop at full rate meanwhile."""
+        hub = self._hub
+        with hub._cond:
+            hub._change_waiters += 1
+        hub._wake.set()
+        try:
+            return self.wait_for_frame(after_seq, timeout)
+        finally:
+            with hub._cond:
+                hub._change_waiters -= 1
+
+    def _publish(self, ts: float, pixels: np.ndarray) -> Frame | None:
+        """
+        Publish a new frame. Returns None when capture restarted on unchanged
+        pixels: the frame from before the stop comes back under its old seq,
+        so ETags and since=/wait_for_change baselines stay valid.
+        """
+        height, width = pixels.shape[:2]
+        with self._cond:
+            parked, self._parked = self._parked, None
+            if parked is not None and same_pixels(pixels, parked.pixels):
+                self._frame = parked
+                self._notify()
+                return None
+            self._seq += 1
+            self._frame = Frame(self._seq, ts, width, height, pixels, channel=self.name)
+            self._notify()
+            return self._frame
+
+    def _clear(self):
+        with self._cond:
+            if self._frame is not None:
+                self._parked = self._frame
+            self._frame = None
+            self._notify()
+
+
+class CaptureHub(FrameChannel):
+    """
+    One streamer's capture producer for its configured region, shared by
+    every consumer of that streamer.
+
+    The capture thread runs while at least one subscriber is attached and
+    publishes each grabbed frame once; /ws clients and /snapshot.png read the
+    latest published frame instead of grabbing the screen themselves.
+    Background mode holds a permanent subscription. Frames come from
+    `source_factory` (the streamer's make_frame_source by default).
+
+    A grab identical to the previous one (a memcmp of the two capture
+    buffers) is not published, so `seq` only advances when the pixels
+    change, also across capture thread restarts (see FrameChannel._publish),
+    which keeps since=/wait_for_change baselines valid. After IDLE_AFTER
+    seconds without a change the capture interval doubles per unchanged
+    grab up to 1/--idle-fps, and it snaps back to the
+    target rate on the first change. While a wait_for_change request is
+    pending the loop stays at the full rate.
+
+    Subscribers may ask for a lower rate (subscribe(fps)); the loop runs at
+    the fastest rate asked for, capped at --fps, and /ws clients
+    decimate from there. Ticks follow monotonic deadlines (next = previous
+    + interval) so the rate does not drift with grab cost; an overrun
+    starts a new schedule instead of bursting to catch up.
+
+    With named regions (see RegionRegistry) each tick grabs the bounding
+    box of the main region and every named region once, and publishes
+    zero-copy slices of it; each channel has its own seq and only
+    publishes when its own slice changed.
+    """
+
+    def __init__(self, streamer: "ScreenStreamer", source_factory=None):
+        super().__init__()
+        self.streamer = streamer
+        self.settings = streamer.settings
+        self.shutdown_flag = streamer.shutdown_flag
+        self.source_factory = source_factory or streamer.make_frame_source
+        self._wake = threading.Event()
+        self._subscribers = 0
+        self._rates = Counter()  # requested fps -> subscribers asking for it
+        self._change_waiters = 0
+        self._thread = None
+        self.error = None
+        self.last_grab_ts = 0.0
+        self.capture_interval = 1.0 / self.settings.target_fps
+
+    def clamp_rate(self, fps: float | None) -> float:
+        target = self.settings.target_fps
+        return target if not fps else min(float(target), max(MIN_CLIENT_FPS, fps))
+
+    def rate(self) -> float:
+        """Capture rate owed to the current subscribers."""
+        with self._cond:
+            if self._change_waiters or not self._rates:
+                return float(self.settings.target_fps)
+            return max(self._rates)
+
+    def subscribe(self, fps: float | None = None):
+        with self._cond:
+            self._subscribers += 1
+            self._rates[self.clamp_rate(fps)] += 1
+            if self._thread is None:
+                self.error = None
+                self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+                self._thread.start()
+        # A new consumer should not wait out an idle back-off interval.
+        self._wake.set()
+
+    def unsubscribe(self, fps: float | None = None):
+        with self._cond:
+            self._subscribers = max(0, self._subscribers - 1)
+            rate = self.clamp_rate(fps)
+            self._rates[rate] -= 1
+            if self._rates[rate] <= 0:
+                del self._rates[rate]
+
+    def _should_stop(self) -> bool:
+        with self._cond:
+            if self._subscribers > 0 and not self.shutdown_flag.is_set():
+                return False
+            # Drop the stale frame so the next subscriber waits for a fresh grab.
+            self._thread = None
+            self._clear()
+        self.streamer.regions.clear_frames()
+        return True
+
+    def _publish_main(self, ts: float, pixels: np.ndarray):
+        published = self._publish(ts, pixels)
+        if published is None:
+            return
+        streamer = self.streamer
+        streamer.metrics.publish_times.append(ts)
+        streamer.update_delta_encoders(published)
+        streamer.history.append(published)
+        if streamer.recorder is not None:
+            streamer.recorder.offer(published)
+
+    def _run(self):
+        streamer = self.streamer
+        settings = self.settings
+        metrics = streamer.metrics
+        interval = 1.0 / settings.target_fps
+        prev_raw = None
+        prev_box = None
+        prev_main = None
+        last_change = time.time()
+        try:
+            with self.source_factory() as source:
+                if settings.use_overlay:
+                    while not streamer.overlay_ready.wait(0.1):
+                        if self._should_stop():
+                            return
+                monitor_region = source.region()
+                print(f"[capture] Using region: {monitor_region} ({source.name}, monitor index {settings.monitor})")
+                next_due = time.monotonic()
+                while not self._should_stop():
+                    start = time.time()
+                    frame_interval = 1.0 / self.rate()
+                    idle_interval = max(frame_interval, 1.0 / settings.idle_fps)
+                    if settings.use_overlay:
                         try:
-                            new_region = get_capture_region(sct)
+                            monitor_region = source.region()
                         except ValueError:
-                            await asyncio.sleep(0.05)
+                            time.sleep(0.05)
                             continue
-                        if new_region != monitor_region:
-                            monitor_region = new_region
-                            init_msg = {
-                                "type": "init",
-                                "width": monitor_region["width"],
-                                "height": monitor_region["height"],
-                            }
-                            await ws.send_text(json.dumps(init_msg))
-
-                    frame = sct.grab(monitor_region)
-                    img = np.asarray(frame)        # BGRA
-                    rgba = img[..., [2, 1, 0, 3]]  # to RGBA
-
-                    await ws.send_bytes(rgba.tobytes())
-
-                    elapsed = asyncio.get_event_loop().time() - start
-                    sleep_time = frame_interval - elapsed
-                    if sleep_time > 0:
-                        await asyncio.sleep(sleep_time)
-
-    except WebSocketDisconnect:
-        print("[ws] client disconnected")
-    except Exception as e:
-        print("[ws] error in capture loop:", e)
-        # Try to notify client, but ignore if already gone
+                    channels = streamer.regions.channels()
+                    box = union_box([monitor_region] + [channel.box for channel in channels])
+                    raw, width, height = source.grab(box)
+                    metrics.observe("grab", time.time() - start)
+                    metrics.grab_times.append(start)
+                    metrics.grab_intervals.tick(time.monotonic())
+                    self.last_grab_ts = start
+                    # bytearray equality is a memcmp: exact, and ~1 ms for 1080p.
+                    # A region added inside the current box still needs its first frame.
+                    fresh = any(channel.latest() is None for channel in channels)
+                    if prev_raw is not None and box == prev_box and raw == prev_raw and not fresh:
+                        if start - last_change >= IDLE_AFTER and not self._change_waiters:
+                            interval = min(interval * 2, idle_interval)
+                    else:
+                        moved = box != prev_box
+                        prev_raw = raw
+                        prev_box = box
+                        last_change = start
+                        interval = frame_interval
+                        # Sources hand over a fresh bytearray per grab, so wrapping
+                        # it is safe and costs no copy; BGRA stays the canonical order.
+                        pixels = np.frombuffer(raw, dtype=np.uint8).reshape(height, width, 4)
+                        pixels.flags.writeable = False
+                        main = slice_box(pixels, box, monitor_region) if channels else pixels
+                        # Without regions a differing grab is a differing main frame;
+                        # otherwise only the main slice decides.
+                        if (not channels and not moved) or not same_pixels(main, prev_main):
+                            prev_main = main
+                            self._publish_main(start, main)
+                        for channel in channels:
+                            channel.offer(start, slice_box(pixels, box, channel.box))
+                    if self._change_waiters:
+                        interval = frame_interval
+                    interval = min(max(interval, frame_interval), idle_interval)
+                    self.capture_interval = interval
+
+                    next_due += interval
+                    now = time.monotonic()
+                    if next_due < now:
+                        next_due = now
+                    if self._wake.wait(next_due - now):
+                        # New subscriber or change waiter: grab now and restart the schedule.
+                        self._wake.clear()
+                        next_due = time.monotonic()
+        except Exception as exc:
+            print(f"[capture] capture stopped: {exc}")
+            with self._cond:
+                self.error = str(exc)
+                self._thread = None
+                self._clear()
+            streamer.regions.clear_frames()
+            if settings.background:
+                self.shutdown_flag.set()
+
+
+def union_box(boxes: list[dict]) -> dict:
+    left = min(box["left"] for box in boxes)
+    top = min(box["top"] for box in boxes)
+    right = max(box["left"] + box["width"] for box in boxes)
+    bottom = max(box["top"] + box["height"] for box in boxes)
+    return {"top": top, "left": left, "width": right - left, "height": bottom - top}
+
+
+def slice_box(pixels: np.ndarray, grabbed: dict, box: dict) -> np.ndarray:
+    """
+    View of `box` inside a grab of `grabbed` (both in screen coordinates).
+    Scales by the grab's pixel density, so HiDPI captures slice correctly.
+    """
+    sx = pixels.shape[1] / grabbed["width"]
+    sy = pixels.shape[0] / grabbed["height"]
+    x = round((box["left"] - grabbed["left"]) * sx)
+    y = round((box["top"] - grabbed["top"]) * sy)
+    return pixels[y:y + max(1, round(box["height"] * sy)), x:x + max(1, round(box["width"] * sx))]
+
+
+def same_pixels(a: np.ndarray | None, b: np.ndarray | None) -> bool:
+    if a is None or b is None or a.shape != b.shape:
+        return False
+    # Compare whole BGRA pixels as uint32 words: 4x fewer elements.
+    return bool(np.array_equal(a.view(np.uint32), b.view(np.uint32)))
+
+
+class RegionChannel(FrameChannel):
+    """A named region: its screen box and the frames sliced out of each grab."""
+
+    def __init__(self, hub: CaptureHub, name: str, box: dict):
+        super().__init__(hub)
+        self.name = name
+        self.box = box
+        self.closed = False
+        self._prev = None
+
+    def offer(self, ts: float, pixels: np.ndarray):
+        """Publish the slice if it differs from the last one published."""
+        if same_pixels(pixels, self._prev):
+            return
+        self._prev = pixels
+        published = self._publish(ts, pixels)
+        if published is not None:
+            self._hub.streamer.update_delta_encoders(published)
+
+    def _clear(self):
+        self._prev = None
+        super()._clear()
+
+    def describe(self) -> dict:
+        frame = self.latest()
+        return {
+            "name": self.name,
+            **self.box,
+            "seq": frame.seq if frame is not None else 0,
+            "frame_size": list(frame.size) if frame is not None else None,
+        }
+
+
+REGION_NAME = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+
+class RegionRegistry:
+    """
+    Named regions, configurable at startup (--region) and at runtime
+    (PUT/DELETE /regions/<name>). The capture thread reads the current set
+    each tick.
+    """
+
+    def __init__(self, hub: CaptureHub):
+        self._hub = hub
+        self._lock = threading.Lock()
+        self._channels = {}
+
+    @staticmethod
+    def parse(spec: str) -> tuple[str, dict]:
+        """Parse NAME=LEFT,TOP,WIDTH,HEIGHT; raises ValueError."""
+        name, sep, coords = spec.partition("=")
+        parts = coords.split(",")
+        if not sep or len(parts) != 4:
+            raise ValueError(f"region must be NAME=LEFT,TOP,WIDTH,HEIGHT, got {spec!r}")
+        left, top, width, height = (int(part) for part in parts)
+        return name.strip(), {"left": left, "top": top, "width": width, "height": height}
+
+    def set(self, name: str, box: dict) -> RegionChannel:
+        if not REGION_NAME.match(name):
+            raise ValueError(f"invalid region name {name!r} (letters, digits, '_', '-', '.')")
+        if box["width"] <= 0 or box["height"] <= 0:
+            raise ValueError("region width and height must be positive")
+        box = {"top": box["top"], "left": box["left"], "width": box["width"], "height": box["height"]}
+        with self._lock:
+            channel = self._channels.get(name)
+            if channel is None:
+                channel = self._channels[name] = RegionChannel(self._hub, name, box)
+            elif channel.box != box:
+                channel.box = box
+                channel._prev = None
+        self._hub._wake.set()
+        return channel
+
+    def remove(self, name: str) -> bool:
+        with self._lock:
+            channel = self._channels.pop(name, None)
+        if channel is None:
+            return False
+        channel.closed = True
+        channel._clear()
+        return True
+
+    def get(self, name: str) -> RegionChannel | None:
+        with self._lock:
+            return self._channels.get(name)
+
+    def channels(self) -> list[RegionChannel]:
+        with self._lock:
+            return list(self._channels.values())
+
+    def clear_frames(self):
+        for channel in self.channels():
+            channel._clear()
+
+
+class FrameHistory:
+    """
+    Fixed-memory ring of recent frames so a consumer that polls late can
+    still fetch a transient dialog or toast.
+
+    All slots live in one preallocated (slots, height, width, 4) BGRA array
+    whose slot count is the byte budget divided by the frame size, next to
+    parallel seq and timestamp arrays. Appending copies the frame into the
+    oldest slot; a region resize reallocates and starts over. Frames older
+    than max_age are treated as evicted even if their slot is not reused yet.
+    """
+
+    def __init__(self, budget_bytes: int, max_age: float):
+        self.budget_bytes = budget_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._size = (0, 0)
+        self._pixels = None
+        self._seqs = np.zeros(0, dtype=np.int64)
+        self._ts = np.zeros(0, dtype=np.float64)
+        self._next = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._pixels.nbytes if self._pixels is not None else 0
+
+    def append(self, frame: Frame):
+        if not self.budget_bytes:
+            return
+        with self._lock:
+            if frame.size != self._size:
+                slots = self.budget_bytes // frame.pixels.nbytes
+                self._size = frame.size
+                self._pixels = np.empty((slots, frame.height, frame.width, 4), dtype=np.uint8) if slots else None
+                self._seqs = np.zeros(slots, dtype=np.int64)
+                self._ts = np.zeros(slots, dtype=np.float64)
+                self._next = 0
+                if not slots:
+                    print(f"[history] {frame.width}x{frame.height} frames exceed the history budget; history disabled")
+            if self._pixels is None:
+                return
+            slot = self._next
+            self._pixels[slot] = frame.pixels
+            self._seqs[slot] = frame.seq
+            self._ts[slot] = frame.ts
+            self._next = (slot + 1) % len(self._seqs)
+
+    def _live(self) -> np.ndarray:
+        return (self._seqs > 0) & (self._ts >= time.time() - self.max_age)
+
+    def list(self, since_seq: int = 0) -> list[dict]:
+        with self._lock:
+            live = np.flatnonzero(self._live() & (self._seqs > since_seq))
+            order = live[np.argsort(self._seqs[live])]
+            return [{"seq": int(self._seqs[i]), "ts": float(self._ts[i])} for i in order]
+
+    def get(self, seq: int) -> Frame | None:
+        """Copy a frame out of its slot (the slot will be reused later)."""
+        with self._lock:
+            slots = np.flatnonzero(self._live() & (self._seqs == seq))
+            if not slots.size:
+                return None
+            slot = slots[0]
+            pixels = self._pixels[slot].copy()
+            pixels.flags.writeable = False
+            width, height = self._size
+            return Frame(seq, float(self._ts[slot]), width, height, pixels)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "capacity": len(self._seqs),
+                "stored": int(self._live().sum()),
+                "width": self._size[0],
+                "height": self._size[1],
+                "bytes": self.nbytes,
+                "budget_bytes": self.budget_bytes,
+                "max_age": self.max_age,
+            }
+
+
+class SessionRecorder:
+    """
+    Appends published frames to segment files on disk for later replay.
+
+    Each segment is a pair of files named by the time of its first frame:
+    `<ms>.seg` holds an 8-byte header (magic, codec) followed by records of
+    RECORD_HEADER plus a compressed payload, and `<ms>.idx` is an array of
+    INDEX_DTYPE entries (seq, ts, offset, kind), written after the record
+    so readers never see an entry ahead of its data. A keyframe payload is
+    the full BGRA frame; a delta payload is the XOR with the previously
+    recorded frame, which is mostly zeros and compresses well. Every
+    segment starts with a keyframe, and one is forced every
+    KEYFRAME_FRAMES records and on size changes, so decoding any frame
+    replays at most that many deltas.
+
+    Writing happens on a thread of its own fed by a small queue; if disk
+    or compression falls behind, frames are skipped (counted in `dropped`)
+    rather than stalling capture. If a write fails, the thread stops,
+    `error` keeps the reason and later frames are ignored. Readers
+    memory-map segments and the index. Segments from earlier runs in the same directory stay
+    replayable by time until retention deletes them.
+    """
+
+    MAGIC = b"SSREC1"
+    CODEC_ZLIB = 0
+    CODEC_ZSTD = 1
+    KEYFRAME, DELTA = 0, 1
+    KEYFRAME_FRAMES = 30
+    RECORD_HEADER = struct.Struct("<BIII")  # kind, width, height, payload length
+    INDEX_DTYPE = np.dtype([("seq", "<u8"), ("ts", "<f8"), ("offset", "<u8"), ("kind", "<u4")])
+
+    def __init__(self, directory: str, max_bytes: int, segment_bytes: int, metrics: Metrics):
+        self.directory = directory
+        self.metrics = metrics
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.codec = self.CODEC_ZSTD if zstandard is not None else self.CODEC_ZLIB
+        self.recorded = 0
+        self.dropped = 0
+        self.error = None  # why the writer thread stopped, if it failed
+        self._queue = queue.Queue(maxsize=4)
+        self._thread = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._segments = sorted(
+            name[:-4] for name in os.listdir(directory)
+            if name.endswith(".idx") and os.path.exists(os.path.join(directory, name[:-4] + ".seg"))
+        )
+        self._maps = {}
+        self._active = None
+        self._data = None
+        self._index = None
+        self._prev = None
+        self._since_keyframe = 0
+        self._decoded = None  # (segment, record index, pixels) of the last decode
+
+    def _path(self, segment: str, ext: str) -> str:
+        return os.path.join(self.directory, f"{segment}.{ext}")
+
+    # ---- writing ----
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="recorder", daemon=True)
+        self._thread.start()
+
+    def offer(self, frame: Frame):
+        if self.error is not None:
+            return
         try:
-            await ws.send_text(json.dumps({
-                "type": "error",
-                "message": f"Server error: {e}",
-            }))
-            await ws.close()
-        except Exception:
-            pass
-
-
-shutdown_flag = threading.Event()
-uvicorn_server = None  # set in __main__, used for cross-thread shutdown requests
-
-
-def get_capture_region(sct: mss.mss) -> dict:
-    if USE_OVERLAY:
-        with overlay_lock:
-            region = overlay_region
-        if not region:
-            raise ValueError("Overlay region not ready")
-        return dict(region)
-
-    monitors = sct.monitors
-    if MONITOR_ID < 0 or MONITOR_ID >= len(monitors):
-        raise ValueError(
-            f"Invalid monitor_id {MONITOR_ID}, available: 0..{len(monitors)-1}"
+            self._queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout: float = 5.0):
+        if self._thread is None:
+            return
+        # A writer that died leaves nobody to drain the queue, so never block on it.
+        if self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        try:
+            while (frame := self._queue.get()) is not None:
+                self._write(frame)
+        except Exception as exc:
+            self.error = str(exc) or type(exc).__name__
+            print(f"[record] recording stopped: {exc}")
+        finally:
+            self._close_segment()
+
+    def _compress(self, data) -> bytes:
+        if self.codec == self.CODEC_ZSTD:
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+        return zlib.compress(data, ZLIB_LEVEL)
+
+    def _write(self, frame: Frame):
+        start = time.time()
+        pixels = np.ascontiguousarray(frame.pixels)
+        if self._data is not None and self._data.tell() >= self.segment_bytes:
+            self._close_segment()
+            self._enforce_retention()
+        if self._data is None:
+            self._open_segment(frame.ts)
+        keyframe = (
+            self._prev is None
+            or self._prev.shape != pixels.shape
+            or self._since_keyframe >= self.KEYFRAME_FRAMES
         )
+        if keyframe:
+            payload = self._compress(pixels)
+            self._since_keyframe = 0
+        else:
+            payload = self._compress(np.bitwise_xor(pixels, self._prev))
+            self._since_keyframe += 1
+        self._prev = pixels
+        kind = self.KEYFRAME if keyframe else self.DELTA
+        offset = self._data.tell()
+        self._data.write(self.RECORD_HEADER.pack(kind, frame.width, frame.height, len(payload)))
+        self._data.write(payload)
+        self._data.flush()
+        entry = np.array([(frame.seq, frame.ts, offset, kind)], dtype=self.INDEX_DTYPE)
+        self._index.write(entry.tobytes())
+        self._index.flush()
+        self.recorded += 1
+        self.metrics.observe("record", time.time() - start)
+
+    def _open_segment(self, ts: float):
+        segment = f"{int(ts * 1000):013d}"
+        self._data = open(self._path(segment, "seg"), "wb")
+        self._data.write(self.MAGIC + bytes([self.codec, 0]))
+        self._index = open(self._path(segment, "idx"), "wb")
+        self._prev = None
+        with self._lock:
+            self._segments.append(segment)
+            self._active = segment
+        print(f"[record] new segment {segment}")
+
+    def _close_segment(self):
+        if self._data is None:
+            return
+        self._data.close()
+        self._index.close()
+        self._data = self._index = None
+        with self._lock:
+            self._active = None
+
+    def _segment_bytes(self, segment: str) -> int:
+        try:
+            return os.path.getsize(self._path(segment, "seg")) + os.path.getsize(self._path(segment, "idx"))
+        except OSError:
+            return 0
+
+    def _enforce_retention(self):
+        with self._lock:
+            segments = [segment for segment in self._segments if segment != self._active]
+            total = sum(self._segment_bytes(segment) for segment in self._segments)
+        for segment in segments:
+            if total <= self.max_bytes:
+                break
+            size = self._segment_bytes(segment)
+            with self._lock:
+                self._segments.remove(segment)
+                self._maps.pop(segment, None)
+                if self._decoded is not None and self._decoded[0] == segment:
+                    self._decoded = None
+            for ext in ("seg", "idx"):
+                try:
+                    os.remove(self._path(segment, ext))
+                except OSError:
+                    pass
+            total -= size
+            print(f"[record] deleted segment {segment} (retention)")
+
+    # ---- reading ----
+
+    def _read_index(self, segment: str) -> np.ndarray:
+        path = self._path(segment, "idx")
+        count = os.path.getsize(path) // self.INDEX_DTYPE.itemsize
+        if not count:
+            return np.zeros(0, dtype=self.INDEX_DTYPE)
+        return np.memmap(path, dtype=self.INDEX_DTYPE, mode="r", shape=(count,))
+
+    def _map(self, segment: str, end: int) -> mmap.mmap:
+        """Read-only map of a segment covering at least `end` bytes (remapped as it grows)."""
+        with self._lock:
+            mapped = self._maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            with open(self._path(segment, "seg"), "rb") as fh:
+                mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            with self._lock:
+                if segment in self._segments:
+                    self._maps[segment] = mapped
+        return mapped
+
+    def segments(self) -> list[dict]:
+        with self._lock:
+            names = list(self._segments)
+            active = self._active
+        result = []
+        for segment in names:
+            try:
+                index = self._read_index(segment)
+            except OSError:
+                continue
+            if not len(index):
+                continue
+            result.append({
+                "segment": segment,
+                "active": segment == active,
+                "frames": len(index),
+                "first_seq": int(index["seq"][0]),
+                "last_seq": int(index["seq"][-1]),
+                "start": float(index["ts"][0]),
+                "end": float(index["ts"][-1]),
+                "bytes": self._segment_bytes(segment),
+            })
+        return result
+
+    def find_time(self, ts: float) -> tuple[str, int] | None:
+        """The last frame recorded at or before ts, as (segment, record index)."""
+        with self._lock:
+            names = list(self._segments)
+        for segment in reversed(names):
+            index = self._read_index(segment)
+            if len(index) and index["ts"][0] <= ts:
+                return segment, int(np.searchsorted(index["ts"], ts, side="right")) - 1
+        return None
+
+    def find_seq(self, seq: int) -> tuple[str, int] | None:
+        """The newest recorded frame with this capture seq (seqs restart per run)."""
+        with self._lock:
+            names = list(self._segments)
+        for segment in reversed(names):
+            index = self._read_index(segment)
+            if len(index) and index["seq"][0] <= seq <= index["seq"][-1]:
+                i = int(np.searchsorted(index["seq"], seq))
+                if i < len(index) and index["seq"][i] == seq:
+                    return segment, i
+        return None
+
+    def _decode_record(self, mapped: mmap.mmap, codec: int, offset: int) -> tuple[int, np.ndarray]:
+        kind, width, height, length = self.RECORD_HEADER.unpack_from(mapped, offset)
+        start = offset + self.RECORD_HEADER.size
+        payload = memoryview(mapped)[start:start + length]
+        try:
+            if codec == self.CODEC_ZSTD:
+                if zstandard is None:
+                    raise RuntimeError("segment is zstd-compressed; install zstandard to replay it")
+                data = zstandard.ZstdDecompressor().decompress(payload)
+            else:
+                data = zlib.decompress(payload)
+        finally:
+            payload.release()
+        return kind, np.frombuffer(data, dtype=np.uint8).reshape(height, width, 4)
+
+    def read(self, segment: str, i: int) -> Frame:
+        """Decode record i of a segment: its keyframe plus the deltas up to it."""
+        index = self._read_index(segment)
+        entry = index[i]
+        last = index[len(index) - 1]
+        mapped = self._map(segment, int(last["offset"]) + self.RECORD_HEADER.size)
+        codec = mapped[len(self.MAGIC)]
+        key = i
+        while index["kind"][key] != self.KEYFRAME:
+            key -= 1
+        with self._lock:
+            decoded = self._decoded
+        if decoded is not None and decoded[0] == segment and key <= decoded[1] <= i:
+            # Scrubbing forward reuses the previous decode instead of the keyframe.
+            first, pixels = decoded[1] + 1, decoded[2].copy()
+        else:
+            first, pixels = key + 1, self._decode_record(mapped, codec, int(index["offset"][key]))[1].copy()
+        for j in range(first, i + 1):
+            _, delta = self._decode_record(mapped, codec, int(index["offset"][j]))
+            np.bitwise_xor(pixels, delta, out=pixels)
+        with self._lock:
+            if segment in self._segments:
+                self._decoded = (segment, i, pixels.copy())
+        pixels.flags.writeable = False
+        height, width = pixels.shape[:2]
+        return Frame(int(entry["seq"]), float(entry["ts"]), width, height, pixels, channel=f"replay:{segment}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            names = list(self._segments)
+        return {
+            "directory": self.directory,
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "error": self.error,
+            "segments": len(names),
+            "bytes": sum(self._segment_bytes(segment) for segment in names),
+            "max_bytes": self.max_bytes,
+        }
 
-    mon = monitors[MONITOR_ID]
 
-    top = mon["top"] + REL_TOP
-    left = mon["left"] + REL_LEFT
-    width = REQ_WIDTH if REQ_WIDTH is not None else (mon["width"] - REL_LEFT)
-    height = REQ_HEIGHT if REQ_HEIGHT is not None else (mon["height"] - REL_TOP)
+class DeltaEncoder:
+    """
+    Tile-based delta stream shared by every /ws client using codec=delta
+    with the same view (crop/scale); see ScreenStreamer.acquire_delta_encoder().
+
+    The capture thread feeds each published frame into a tile-padded buffer
+    and compares it with the previous one as uint32 pixels, keeping one
+    boolean change mask per frame. A client that is behind receives the
+    changed tiles of every frame it missed (the union of their masks), so
+    clients in lockstep share one encoded payload. New clients, clients
+    that fell out of the mask history and periodic keyframes get the whole
+    frame instead.
+
+    Envelope (little-endian): seq u32, tile count u32, tile size u16,
+    flags u16, then tile indices as u32 and the tiles' pixel rows (RGBA or
+    BGRA, as negotiated) in the same order. With FLAG_KEYFRAME the body is
+    the full unpadded frame.
+    """
 
-    if width <= 0 or height <= 0:
-        raise ValueError(f"Computed invalid region width={width}, height={height}")
+    HEADER = struct.Struct("<IIHH")
+    FLAG_KEYFRAME = 1
+
+    def __init__(
+        self, tile_size: int, keyframe_interval: float, view: "ViewSpec", pipeline: "EncodePipeline", history: int = 64
+    ):
+        self.tile_size = tile_size
+        self.view = view
+        self.pipeline = pipeline
+        self.channel = ""
+        self.keyframe_interval = keyframe_interval
+        self._lock = threading.Lock()
+        self._users = 0
+        self._masks = deque(maxlen=history)
+        self._reset()
+
+    def _reset(self):
+        self._frame = None
+        self._size = (0, 0)
+        self._tiles = (0, 0)
+        self._prev = None
+        self._cur = None
+        self._base_seq = 0
+        self._keyframe_seq = 0
+        self._keyframe_ts = 0.0
+        self._masks.clear()
+        self._cache = {}
+
+    def acquire(self):
+        with self._lock:
+            self._users += 1
+
+    def release(self) -> int:
+        with self._lock:
+            self._users = max(0, self._users - 1)
+            if self._users == 0:
+                self._reset()
+            return self._users
+
+    def update(self, frame: Frame, seed: bool = False):
+        """Feed a published frame; with seed, only if the encoder has none yet."""
+        with self._lock:
+            if self._users == 0 or (seed and self._frame is not None):
+                return
+            frame = self.pipeline.frame_view(frame, self.view)
+            started = time.perf_counter()
+            tile = self.tile_size
+            if frame.size != self._size:
+                self._reset()
+                tiles_y = -(-frame.height // tile)
+                tiles_x = -(-frame.width // tile)
+                self._size = frame.size
+                self._tiles = (tiles_y, tiles_x)
+                self._prev = np.zeros((tiles_y * tile, tiles_x * tile, 4), dtype=np.uint8)
+                self._cur = np.zeros_like(self._prev)
+            if self._frame is None:
+                self._base_seq = frame.seq
+
+            # Reuse the two padded buffers; the padding stays zero in both.
+            self._prev, self._cur = self._cur, self._prev
+            self._cur[:frame.height, :frame.width] = frame.pixels
+
+            tiles_y, tiles_x = self._tiles
+            changed = self._cur.view(np.uint32)[..., 0] != self._prev.view(np.uint32)[..., 0]
+            mask = changed.reshape(tiles_y, tile, tiles_x, tile).any(axis=(1, 3))
+            self._masks.append((frame.seq, mask))
+
+            if frame.seq == self._base_seq or frame.ts - self._keyframe_ts >= self.keyframe_interval:
+                self._keyframe_seq = frame.seq
+                self._keyframe_ts = frame.ts
+            self._frame = frame
+            self._cache.clear()
+            self.pipeline.metrics.observe("delta", time.perf_counter() - started)
+
+    @property
+    def nbytes(self) -> int:
+        return (self._prev.nbytes + self._cur.nbytes) if self._cur is not None else 0
+
+    def encode(self, since_seq: int, pixel_format: str = "rgba") -> tuple[Frame | None, bytes | None]:
+        """Return the latest frame and the payload that brings a client at since_seq up to it."""
+        with self._lock:
+            frame = self._frame
+            if frame is None or frame.seq <= since_seq:
+                return frame, None
+
+            keyframe = (
+                since_seq < self._base_seq
+                or frame.seq == self._keyframe_seq
+                or self._masks[0][0] > since_seq + 1
+            )
+            key = ("key" if keyframe else since_seq, pixel_format)
+            payload = self._cache.get(key)
+            if payload is not None:
+                return frame, payload
+
+            started = time.perf_counter()
+            tile = self.tile_size
+            if keyframe:
+                header = self.HEADER.pack(frame.seq, 0, tile, self.FLAG_KEYFRAME)
+                payload = b"".join((header, self.pipeline.frame_pixels(frame, pixel_format)))
+            else:
+                masks = [mask for seq, mask in self._masks if seq > since_seq]
+                mask = np.logical_or.reduce(masks) if len(masks) > 1 else masks[0]
+                indices = np.flatnonzero(mask)
+                tiles_y, tiles_x = self._tiles
+                tiles = self._cur.reshape(tiles_y, tile, tiles_x, tile, 4)[indices // tiles_x, :, indices % tiles_x]
+                if pixel_format == "rgba":
+                    tiles = bgra_to_rgba(tiles)
+                payload = b"".join((
+                    self.HEADER.pack(frame.seq, indices.size, tile, 0),
+                    indices.astype("<u4").tobytes(),
+                    tiles.tobytes(),
+                ))
+            self._cache[key] = payload
+            self.pipeline.metrics.observe("delta", time.perf_counter() - started)
+            return frame, payload
+
+
+class EncodedFrameCache:
+    """
+    Small LRU of per-frame derived data: resized views, RGBA conversions and
+    encodings, keyed by frame seq plus whatever distinguishes the variant.
 
-    return {
-        "top": top,
-        "left": left,
-        "width": width,
-        "height": height,
-    }
+    Frames are encoded on demand from the latest raw frame, so the capture
+    loop never pays for PNG/zlib work nobody asked for. /ws clients that
+    negotiated the same codec and repeated snapshot requests for an
+    unchanged frame reuse the same bytes.
+    """
 
+    def __init__(self, metrics: Metrics, max_entries: int = 16):
+        self.metrics = metrics
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._pending = {}
+        self.nbytes = 0
+
+    def get_or_encode(self, key: tuple, encode, stage: str = "encode"):
+        """
+        Return the cached bytes for key, calling encode() at most once even
+        when several encode workers ask for the same key concurrently.
+        """
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                return data
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = Future()
+        if not owner:
+            return pending.result()
+
+        started = time.perf_counter()
+        try:
+            data = encode()
+            self.metrics.observe(stage, time.perf_counter() - started)
+        except BaseException as exc:
+            pending.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            self.nbytes += sizeof_entry(data)
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= sizeof_entry(evicted)
+        pending.set_result(data)
+        return data
+
+
+def sizeof_entry(value) -> int:
+    if isinstance(value, Frame):
+        return value.pixels.nbytes
+    if isinstance(value, (np.ndarray, memoryview)):
+        return value.nbytes
+    return len(value)
+
+
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 3
+
+
+def encode_image(pixels: np.ndarray, codec: str, quality: int) -> bytes:
+    """PNG/JPEG/WebP bytes of contiguous BGRA pixels."""
+    # BGRX unpacks straight from the capture buffer and drops alpha, so no
+    # swizzle copy is needed and images stay 3-channel.
+    height, width = pixels.shape[:2]
+    img = Image.frombytes("RGB", (width, height), pixels, "raw", "BGRX")
+    pil_format, _ = IMAGE_FORMATS[codec]
+    out = BytesIO()
+    if pil_format == "PNG":
+        img.save(out, format=pil_format)
+    else:
+        img.save(out, format=pil_format, quality=quality)
+    return out.getvalue()
+
+
+def bgra_to_rgba(bgra: np.ndarray) -> np.ndarray:
+    # Per-channel copies into one output buffer avoid the index array and
+    # temporaries of a fancy-indexed img[..., [2, 1, 0, 3]].
+    rgba = np.empty_like(bgra)
+    rgba[..., 0] = bgra[..., 2]
+    rgba[..., 1] = bgra[..., 1]
+    rgba[..., 2] = bgra[..., 0]
+    rgba[..., 3] = bgra[..., 3]
+    return rgba
+
+
+@dataclass(frozen=True)
+class ViewSpec:
+    """
+    Crop-then-downscale geometry requested through the crop, scale and
+    max_side query parameters. It is resolved against each frame's size,
+    so it keeps working when the overlay region is resized.
+    """
 
-def capture_background():
-    global latest_rgba, latest_png, latest_size, last_capture_ts
-    frame_interval = 1.0 / TARGET_FPS
+    crop: tuple[int, int, int, int] | None = None
+    scale: float = 1.0
+    max_side: int = 0
+
+    @classmethod
+    def parse(cls, scale: float = 1.0, max_side: int = 0, crop: str | None = None) -> "ViewSpec":
+        if not scale > 0:
+            raise ValueError("scale must be > 0")
+        if max_side < 0:
+            raise ValueError("max_side must be >= 0")
+        box = None
+        if crop:
+            try:
+                box = tuple(int(part) for part in crop.split(","))
+            except ValueError:
+                box = ()
+            if len(box) != 4 or box[0] < 0 or box[1] < 0 or box[2] <= 0 or box[3] <= 0:
+                raise ValueError("crop must be x,y,w,h with non-negative x,y and positive w,h")
+        # Upscaling only wastes bandwidth, so scale is capped at 1.
+        return cls(box, min(1.0, scale), max_side)
+
+    def resolve(self, width: int, height: int) -> tuple[tuple[int, int, int, int], tuple[int, int]]:
+        """Return the crop box clipped to the frame and the output size."""
+        x, y, w, h = self.crop or (0, 0, width, height)
+        x = min(x, width - 1)
+        y = min(y, height - 1)
+        w = min(w, width - x)
+        h = min(h, height - y)
+        factor = self.scale
+        if self.max_side and max(w, h) * factor > self.max_side:
+            factor = self.max_side / max(w, h)
+        return (x, y, w, h), (max(1, round(w * factor)), max(1, round(h * factor)))
+
+    def describe(self) -> str:
+        parts = []
+        if self.crop:
+            parts.append("crop=" + ",".join(str(v) for v in self.crop))
+        if self.scale != 1.0:
+            parts.append(f"scale={self.scale:g}")
+        if self.max_side:
+            parts.append(f"max_side={self.max_side}")
+        return "&".join(parts) or "full"
+
+
+FULL_VIEW = ViewSpec()
+
+
+def area_downscale(pixels: np.ndarray, box: tuple[int, int, int, int], out_size: tuple[int, int]) -> np.ndarray:
+    """
+    Box-filter (area average) downscale of the `box` = (x, y, w, h) part of
+    a contiguous BGRA frame, any ratio. PIL's BOX resample does this in C
+    straight from the capture buffer, cropping via its `box` argument so the
+    crop is never copied; channel order does not matter to the filter.
+    Roughly 5x faster than the np.add.reduceat version it replaces.
+
+    The frame is loaded as RGBX, not RGBA: PIL premultiplies alpha when
+    resizing RGBA, which blacks out pixels whose (possibly invalid, per
+    mss) alpha byte is 0. The output gets a constant alpha of 255.
+    """
+    height, width = pixels.shape[:2]
+    x, y, w, h = box
+    img = Image.frombuffer("RGBX", (width, height), pixels, "raw", "RGBX", 0, 1)
+    small = img.resize(out_size, Image.Resampling.BOX, box=(x, y, x + w, y + h))
+    return np.asarray(small.convert("RGBA"))
+
+
+_worker_segments = {}  # slot name -> shared memory attached in an encode worker process
+_worker_generation = 0  # slot generation the attached segments belong to
+
+
+def _encode_in_worker(name: str, generation: int, shape: tuple, codec: str, quality: int) -> bytes:
+    global _worker_generation
+    if generation != _worker_generation:
+        # The parent reallocated its slots; the old segments are unlinked, so let them go.
+        for segment in _worker_segments.values():
+            segment.close()
+        _worker_segments.clear()
+        _worker_generation = generation
+    segment = _worker_segments.get(name)
+    if segment is None:
+        segment = _worker_segments[name] = shared_memory.SharedMemory(name=name)
+    pixels = np.ndarray(shape, dtype=np.uint8, buffer=segment.buf)
     try:
-        with mss.mss() as sct:
-            if USE_OVERLAY:
-                overlay_ready.wait()
-            monitor_region = get_capture_region(sct)
-            print(f"[capture] Background region: {monitor_region} (monitor index {MONITOR_ID})")
-            while not shutdown_flag.is_set():
-                start = time.time()
-                if USE_OVERLAY:
-                    try:
-                        monitor_region = get_capture_region(sct)
-                    except ValueError:
-                        time.sleep(0.05)
-                        continue
-                frame = sct.grab(monitor_region)
-                img = np.asarray(frame)        # BGRA
-                rgba = img[..., [2, 1, 0, 3]]  # to RGBA
-                png_bytes = tools.to_png(frame.rgb, frame.size)
-
-                with frame_lock:
-                    latest_rgba = rgba.tobytes()
-                    latest_png = png_bytes
-                    latest_size = frame.size
-                    last_capture_ts = start
-
-                elapsed = time.time() - start
-                sleep_time = frame_interval - elapsed
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
-    except Exception as exc:
-        print(f"[capture] background capture stopped: {exc}")
-        shutdown_flag.set()
+        return encode_image(pixels, codec, quality)
+    finally:
+        del pixels  # release the export before the segment may be closed
+
+
+def _worker_ready(_=None) -> int:
+    return os.getpid()
 
 
-@app.get("/snapshot.png")
-async def snapshot_png():
+class ProcessEncodePool:
     """
-    Returns a single PNG frame for preview or download.
+    PNG/JPEG/WebP encoding in worker processes, for resolutions where one
+    core (and the GIL shared with the event loop) cannot keep up.
+
+    Frames are not pickled: the dispatching thread copies the pixels into
+    a free shared-memory slot and sends only the slot name, shape and
+    codec; the encoded bytes (much smaller) come back through the pool.
+    There are two slots per worker, sized for the largest frame seen and
+    reallocated when the frame grows. Each reallocation starts a new slot
+    generation, sent with every task, so workers close their handles to
+    the replaced segments instead of keeping them mapped. With every slot
+    busy the frame is
+    encoded in the calling thread instead of queueing. Each call waits for
+    its own result only; there is no global ordering, so a slow PNG
+    snapshot does not hold back a JPEG stream frame finished after it.
+    Every consumer encodes its frames one at a time, which already keeps
+    its own frames in order.
+
+    Callers are the EncodePipeline threads, via its cache, so identical
+    requests still share one encode.
     """
-    if BACKGROUND_CAPTURE:
-        with frame_lock:
-            png_bytes = latest_png
-        if png_bytes is None:
-            return Response(content=b"", status_code=503, media_type="text/plain")
-        return Response(content=png_bytes, media_type="image/png")
 
-    try:
-        with mss.mss() as sct:
-            monitor_region = get_capture_region(sct)
-            frame = sct.grab(monitor_region)
-            png_bytes = tools.to_png(frame.rgb, frame.size)
-            return Response(content=png_bytes, media_type="image/png")
-    except ValueError as exc:
-        return Response(content=str(exc).encode("utf-8"), status_code=503, media_type="text/plain")
-    except Exception as exc:
-        return Response(content=f"capture error: {exc}".encode("utf-8"), status_code=500, media_type="text/plain")
+    def __init__(self, processes: int):
+        self.processes = processes
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = []
+        self._free = []
+        self._slot_bytes = 0
+        self._generation = 0
+        self._in_flight = 0
+        self.fallbacks = 0
+
+    def start(self):
+        """Spawn the workers now rather than on the first frame."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+            list(self._executor.map(_worker_ready, range(self.processes)))
+            print(f"[encode] {self.processes} encode processes started")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        with self._lock:
+            for slot in self._slots:
+                slot.close()
+                slot.unlink()
+            self._slots, self._free = [], []
+
+    def _acquire(self, nbytes: int):
+        with self._lock:
+            if nbytes > self._slot_bytes:
+                if len(self._free) != len(self._slots):
+                    return None, 0  # resize once the in-flight slots come back
+                for slot in self._slots:
+                    slot.close()
+                    slot.unlink()
+                self._slot_bytes = nbytes
+                self._generation += 1
+                self._slots = [shared_memory.SharedMemory(create=True, size=nbytes) for _ in range(self.processes * 2)]
+                self._free = list(self._slots)
+            return (self._free.pop(), self._generation) if self._free else (None, 0)
+
+    def _release(self, slot):
+        with self._lock:
+            if slot in self._slots:
+                self._free.append(slot)
+            else:
+                slot.close()
+                slot.unlink()
+
+    def encode(self, pixels: np.ndarray, codec: str, quality: int) -> bytes:
+        """Blocking; returns the encoded bytes of BGRA pixels (any strides)."""
+        if self._executor is None:
+            self.start()
+        slot, generation = self._acquire(pixels.nbytes)
+        if slot is None:
+            self.fallbacks += 1
+            return encode_image(np.ascontiguousarray(pixels), codec, quality)
+        with self._lock:
+            self._in_flight += 1
+        try:
+            np.copyto(np.ndarray(pixels.shape, dtype=np.uint8, buffer=slot.buf), pixels)
+            return self._executor.submit(_encode_in_worker, slot.name, generation, pixels.shape, codec, quality).result()
+        finally:
+            self._release(slot)
+            with self._lock:
+                self._in_flight -= 1
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._slots) * self._slot_bytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "processes": self.processes,
+                "slots": len(self._slots),
+                "slots_busy": len(self._slots) - len(self._free),
+                "slot_bytes": self._slot_bytes,
+                "in_flight": self._in_flight,
+                "fallbacks": self.fallbacks,
+            }
+
+
+class EncodePipeline:
+    """
+    One streamer's frame conversion and encoding: the cache of derived
+    frames and encodings, the thread pool that resizes and encodes off the
+    event loop (zlib, PIL, delta tile gathers), and the optional encode
+    processes. start() creates the pools and shutdown() releases them; a
+    pipeline that was shut down can be started again.
+    """
 
+    def __init__(self, metrics: Metrics, workers: int = 2, processes: int = 0):
+        self.metrics = metrics
+        self.workers = workers
+        self.processes = processes
+        self.cache = EncodedFrameCache(metrics)
+        self.pool = None
+        self.process_encoder = None
+
+    def start(self):
+        if self.pool is None:
+            # With encode processes these threads only dispatch, so there is one per process at least.
+            self.pool = ThreadPoolExecutor(max_workers=max(self.workers, self.processes), thread_name_prefix="encode")
+        if self.processes and self.process_encoder is None:
+            self.process_encoder = ProcessEncodePool(self.processes)
+            self.process_encoder.start()
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+        if self.process_encoder is not None:
+            self.process_encoder.shutdown()
+            self.process_encoder = None
+
+    async def run(self, fn, *args):
+        """Run a blocking call in the encode pool."""
+        if self.pool is None:
+            raise RuntimeError("encode pool is not running; start the ScreenStreamer first")
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    def encode_frame(self, frame: Frame, codec: str, quality: int = 0, pixel_format: str = "rgba"):
+        """
+        Encode a frame once per (view, codec, quality, pixel format); later
+        callers share the result. Raw frames come back as a memoryview so they
+        reach the socket without another copy. Blocking: call it from the encode
+        pool (see encode_view_async).
+        """
+        if codec == "raw":
+            return memoryview(self.frame_pixels(frame, pixel_format)).cast("B")
+        if codec in IMAGE_FORMATS:
+            pixel_format = ""
+        key = (frame.channel, frame.seq, frame.view, codec, quality, pixel_format)
+        return self.cache.get_or_encode(key, lambda: self._encode(frame, codec, quality, pixel_format))
+
+    def _encode(self, frame: Frame, codec: str, quality: int, pixel_format: str) -> bytes:
+        if codec == "zlib":
+            return zlib.compress(self.frame_pixels(frame, pixel_format), ZLIB_LEVEL)
+        if codec == "zstd":
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(self.frame_pixels(frame, pixel_format))
+        if self.process_encoder is not None:
+            return self.process_encoder.encode(frame.pixels, codec, quality)
+        return encode_image(self.frame_pixels(frame, "bgra"), codec, quality)
+
+    def frame_pixels(self, frame: Frame, pixel_format: str) -> np.ndarray:
+        """
+        Contiguous pixels for encoders: the captured BGRA view as-is, or a copy
+        made once per frame and shared (RGBA, or BGRA for a strided slice of a
+        multi-region grab).
+        """
+        if pixel_format == "bgra":
+            if frame.pixels.flags.c_contiguous:
+                return frame.pixels
+            return self.cache.get_or_encode(
+                (frame.channel, frame.seq, frame.view, "bgra"), lambda: np.ascontiguousarray(frame.pixels), "convert"
+            )
+        return self.cache.get_or_encode(
+            (frame.channel, frame.seq, frame.view, "rgba"), lambda: bgra_to_rgba(frame.pixels), "convert"
+        )
 
-def run_overlay_window():
+    def frame_view(self, frame: Frame, view: ViewSpec) -> Frame:
+        """
+        Crop/downscale a frame once per (seq, geometry) and share the result.
+        Blocking when a resize is needed: call it from the encode pool.
+        """
+        box, out_size = view.resolve(frame.width, frame.height)
+        if box == (0, 0, frame.width, frame.height) and out_size == frame.size:
+            return frame
+
+        def build() -> Frame:
+            x, y, w, h = box
+            if out_size != (w, h):
+                pixels = area_downscale(self.frame_pixels(frame, "bgra"), box, out_size)
+            else:
+                pixels = np.ascontiguousarray(frame.pixels[y:y + h, x:x + w])
+            pixels.flags.writeable = False
+            return Frame(frame.seq, frame.ts, out_size[0], out_size[1], pixels, (box, out_size), frame.channel)
+
+        return self.cache.get_or_encode((frame.channel, frame.seq, "view", box, out_size), build, "convert")
+
+    def encode_view(self, frame: Frame, view: ViewSpec, codec: str, quality: int, pixel_format: str):
+        frame = self.frame_view(frame, view)
+        return frame, self.encode_frame(frame, codec, quality, pixel_format)
+
+    async def encode_view_async(
+        self, frame: Frame, view: ViewSpec, codec: str, quality: int = 0, pixel_format: str = "rgba"
+    ):
+        """
+        Return (view frame, encoded bytes). Zero-copy raw BGRA skips the pool
+        hop; a strided region slice still needs a copy, so it takes the pool.
+        """
+        if codec == "raw" and pixel_format == "bgra" and view == FULL_VIEW and frame.pixels.flags.c_contiguous:
+            return frame, self.encode_frame(frame, codec, quality, pixel_format)
+        return await self.run(self.encode_view, frame, view, codec, quality, pixel_format)
+
+
+def available_codecs() -> list[str]:
+    codecs = ["raw", "delta", "zlib", "jpeg", "webp"]
+    if zstandard is not None:
+        codecs.insert(3, "zstd")
+    return codecs
+
+
+def negotiate_codec(requested: str) -> str:
+    """Pick the first supported codec from a comma-separated preference list."""
+    supported = available_codecs()
+    for name in requested.split(","):
+        name = name.strip().lower()
+        if name == "jpg":
+            name = "jpeg"
+        if name in supported:
+            return name
+    return "raw"
+
+
+def format_prometheus(data: dict) -> str:
+    lines = []
+
+    def metric(name: str, kind: str, help_text: str, samples):
+        lines.append(f"# HELP screen_stream_{name} {help_text}")
+        lines.append(f"# TYPE screen_stream_{name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+            suffix = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"screen_stream_{name}{suffix} {value}")
+
+    lines.append("# HELP screen_stream_stage_seconds Latency of each pipeline stage.")
+    lines.append("# TYPE screen_stream_stage_seconds histogram")
+    for stage, hist in data["stages"].items():
+        for bound, count in hist["buckets"]:
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            lines.append(f'screen_stream_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+        lines.append(f'screen_stream_stage_seconds_sum{{stage="{stage}"}} {hist["sum"]:.6f}')
+        lines.append(f'screen_stream_stage_seconds_count{{stage="{stage}"}} {hist["count"]}')
+
+    metric("target_fps", "gauge", "Configured capture rate.", [({}, data["target_fps"])])
+    metric("capture_fps", "gauge", "Achieved grab rate over the recent window.", [({}, data["capture_fps"])])
+    metric("publish_fps", "gauge", "Rate of visually changed frames published.", [({}, data["publish_fps"])])
+    metric("capture_interval_seconds", "gauge", "Current capture interval, including idle back-off.",
+           [({}, data["capture_interval_seconds"])])
+    metric("capture_rate_fps", "gauge", "Capture rate owed to subscribers (fastest requested).",
+           [({}, data["capture_rate_fps"])])
+    if data["grab_intervals"]["samples"]:
+        metric("grab_interval_jitter_seconds", "gauge", "Standard deviation of recent grab intervals.",
+               [({}, data["grab_intervals"]["stdev_ms"] / 1000.0)])
+    metric("latest_frame_seq", "gauge", "Sequence number of the latest published frame.", [({}, data["latest_frame_seq"])])
+    if data["latest_frame_age_seconds"] is not None:
+        metric("latest_frame_age_seconds", "gauge", "Age of the latest published frame.",
+               [({}, data["latest_frame_age_seconds"])])
+    if data["last_grab_age_seconds"] is not None:
+        metric("last_grab_age_seconds", "gauge", "Time since the last screen grab.", [({}, data["last_grab_age_seconds"])])
+    metric("bytes_sent_total", "counter", "Bytes sent to /ws and /stream.mjpg clients.", [({}, data["bytes_sent"])])
+    metric("frames_sent_total", "counter", "Frames sent to /ws and /stream.mjpg clients.", [({}, data["frames_sent"])])
+    metric("mjpeg_streams", "gauge", "Open /stream.mjpg connections.", [({}, data["mjpeg_streams"])])
+    metric("frames_dropped_total", "counter", "Frames replaced before a slow /ws client sent them.",
+           [({}, data["frames_dropped"])])
+    metric("buffer_bytes", "gauge", "Memory held by frame buffers.",
+           [({"pool": pool}, size) for pool, size in data["buffer_bytes"].items()])
+    recorder = data["recorder"]
+    if recorder is not None:
+        metric("record_frames_total", "counter", "Frames written by --record.", [({}, recorder["recorded"])])
+        metric("record_dropped_total", "counter", "Frames --record skipped because the writer fell behind.",
+               [({}, recorder["dropped"])])
+        metric("record_failed", "gauge", "1 once the --record writer stopped on an error.",
+               [({}, int(recorder["error"] is not None))])
+    clients = data["clients"]
+    metric("client_frames_sent_total", "counter", "Frames sent per /ws client.",
+           [({"client": c["id"], "codec": c["codec"]}, c["sent"]) for c in clients])
+    metric("client_frames_dropped_total", "counter", "Frames dropped per /ws client.",
+           [({"client": c["id"], "codec": c["codec"]}, c["dropped"]) for c in clients])
+    metric("client_bytes_sent_total", "counter", "Bytes sent per /ws client.",
+           [({"client": c["id"], "codec": c["codec"]}, c["bytes_sent"]) for c in clients])
+    metric("client_fps", "gauge", "Frame rate requested per /ws client.",
+           [({"client": c["id"], "codec": c["codec"]}, c["fps"]) for c in clients])
+    metric("client_interval_jitter_seconds", "gauge", "Standard deviation of frame intervals per /ws client.",
+           [({"client": c["id"], "codec": c["codec"]}, c["intervals"]["stdev_ms"] / 1000.0)
+            for c in clients if c["intervals"]["samples"]])
+    return "\n".join(lines) + "\n"
+
+
+def run_overlay_window(streamer: "ScreenStreamer"):
     try:
         from PyQt6 import QtCore, QtWidgets
     except Exception as exc:
@@ -639,10 +2023,9 @@ def run_overlay_window():
                 "width": width,
                 "height": height,
             }
-            with overlay_lock:
-                global overlay_region
-                overlay_region = region
-                overlay_ready.set()
+            with streamer.overlay_lock:
+                streamer.overlay_region = region
+                streamer.overlay_ready.set()
 
         def moveEvent(self, event):
             self.update_region()
@@ -661,68 +2044,347 @@ def run_overlay_window():
     window.show()
 
     def poll_shutdown():
-        if shutdown_flag.is_set() or (uvicorn_server is not None and uvicorn_server.should_exit):
+        if streamer.exiting():
             app.quit()
 
     timer = QtCore.QTimer()
     timer.timeout.connect(poll_shutdown)
     timer.start(200)
-    app.aboutToQuit.connect(lambda: request_shutdown("overlay closed"))
+    app.aboutToQuit.connect(lambda: streamer.request_shutdown("overlay closed"))
     app.exec()
 
 
-def request_shutdown(reason: str):
-    """Flag the server to stop and tell uvicorn to exit."""
-    global uvicorn_server
-    if shutdown_flag.is_set():
-        return
-    shutdown_flag.set()
-    print(f"\n[server] {reason}, shutting down...")
-    if uvicorn_server is not None:
-        uvicorn_server.should_exit = True
-        uvicorn_server.force_exit = True
-
+class ScreenStreamer:
+    """
+    In-process capture API; the HTTP server and the CLI are layers on top.
+
+        with ScreenStreamer(source="synthetic", fps=30, regions={"sim": (0, 0, 430, 932)}) as streamer:
+            frame = streamer.wait_frame()
+            frame.seq, frame.ts, frame.pixels  # pixels: read-only (h, w, 4) BGRA view
+            async for frame in streamer.frames("sim", fps=5): ...
+
+    Options are the CLI option names (monitor, left, top, width, height,
+    fps, source, record, encode_processes, ...). Frames are the published
+    Frame objects themselves, so no pixels are copied; a frame stays valid
+    for as long as it is referenced. `background` (default on) keeps
+    capture running between calls, so latest_frame() is always current;
+    without it capture only runs while frames() iterators are active.
+
+    Each streamer owns its capture thread, regions, history, recorder and
+    encode pools, so several can run in one process. create_app() builds
+    an HTTP API bound to this streamer and serve() runs it; both import
+    fastapi and uvicorn only when called.
+    """
 
-if __name__ == "__main__":
-    print(f"[server] starting on http://{args.host}:{args.port}")
-    print("[server] Press Ctrl+C to exit")
-
-    if BACKGROUND_CAPTURE:
-        bg_thread = threading.Thread(target=capture_background, daemon=True)
-        bg_thread.start()
-
-    config = uvicorn.Config(
-        app,
-        host=args.host,
-        port=args.port,
-        log_level="info",
-        # We install our own signal handlers below.
-        timeout_keep_alive=5,
-        reload=False,
-    )
-    uvicorn_server = uvicorn.Server(config)
-
-    # Custom signal handlers ensure Ctrl+C/SIGTERM always request shutdown,
-    # even while a websocket capture loop is running.
-    def _handle_signal(sig_num, _frame):
-        sig_name = signal.Signals(sig_num).name
-        request_shutdown(f"signal {sig_name} received")
-
-    for sig in (signal.SIGINT, signal.SIGTERM):
+    def __init__(self, regions: dict | None = None, background: bool = True, **options):
+        defaults = vars(parser.parse_args([]))
+        unknown = sorted(set(options) - set(defaults))
+        if unknown:
+            raise TypeError(f"unknown ScreenStreamer options: {', '.join(unknown)}")
+        self.options = argparse.Namespace(**{**defaults, **options, "background": background})
+        self.settings = Settings(self.options)
+        self.shutdown_flag = threading.Event()
+        self.server = None  # the uvicorn server while serve() runs
+        self.metrics = Metrics()
+        self.hub = CaptureHub(self)
+        self.regions = RegionRegistry(self.hub)
+        self.history = FrameHistory(self.settings.history_bytes, self.settings.history_seconds)
+        self.recorder = None
+        self.pipeline = EncodePipeline(self.metrics, self.settings.encode_workers, self.settings.encode_processes)
+        self.ws_clients = {}  # id -> WsClient of the HTTP layer, reported by collect_metrics()
+        self.mjpeg_streams = 0
+        # Sequence numbers restart with each streamer; the boot id keeps ETags unique.
+        self.boot_id = uuid.uuid4().hex[:8]
+        self.overlay_lock = threading.Lock()
+        self.overlay_region = None
+        self.overlay_ready = threading.Event()
+        self._delta_encoders = {}  # (channel, view) -> DeltaEncoder
+        self._delta_lock = threading.Lock()
+        self._stops = []  # (loop, future) that end running frames() iterators
+        self._subscribed = False
+        self._running = False
+        for spec in self.options.region:
+            name, box = RegionRegistry.parse(spec)
+            self.set_region(name, box["left"], box["top"], box["width"], box["height"])
+        for name, (left, top, width, height) in (regions or {}).items():
+            self.set_region(name, left, top, width, height)
+
+    @classmethod
+    def from_args(cls, options: argparse.Namespace) -> "ScreenStreamer":
+        """Build a streamer from parsed CLI arguments."""
+        return cls(**vars(options))
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def make_frame_source(self) -> FrameSource:
+        settings = self.settings
+        if settings.source == "synthetic":
+            return SyntheticSource(settings.req_width or 1280, settings.req_height or 720, settings.pattern)
+        return MssSource(self)
+
+    def start(self) -> "ScreenStreamer":
+        if self._running:
+            return self
+        previous = self.hub._thread
+        if previous is not None:
+            # A capture thread left over from before stop(): let it see no subscribers.
+            self.hub._wake.set()
+            previous.join(timeout=5.0)
+        settings = self.settings
+        self.shutdown_flag.clear()
+        settings.print_config()
+        for channel in self.regions.channels():
+            print(f"[regions] {channel.name} -> {channel.box}")
+
+        self.history = FrameHistory(settings.history_bytes, settings.history_seconds)
+        self.pipeline.start()
+        if settings.record_dir:
+            self.recorder = SessionRecorder(
+                settings.record_dir, settings.record_max_bytes, settings.record_segment_bytes, self.metrics
+            )
+            self.recorder._enforce_retention()
+            self.recorder.start()
+
+        self._running = True
+        if settings.background or self.recorder is not None:
+            self.hub.subscribe()
+            self._subscribed = True
+        return self
+
+    def stop(self, timeout: float = 5.0):
+        """Stop capture, end frames() iterators and release encoders and the recorder."""
+        if not self._running:
+            return
+        for loop, stop in self._stops:
+            loop.call_soon_threadsafe(_resolve_waiter, stop)
+        if self._subscribed:
+            self.hub.unsubscribe()
+            self._subscribed = False
+        with self.hub._cond:
+            # frames() iterators still draining on their loops stop it later.
+            thread = self.hub._thread if not self.hub._subscribers else None
+        self.hub._wake.set()
+        if thread is not None:
+            thread.join(timeout)
+        if self.recorder is not None:
+            self.recorder.close(timeout)
+        self.pipeline.shutdown()
+        self._running = False
+
+    def __enter__(self) -> "ScreenStreamer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def exiting(self) -> bool:
+        return self.shutdown_flag.is_set() or (self.server is not None and self.server.should_exit)
+
+    def request_shutdown(self, reason: str, force: bool = True):
+        """
+        Flag the streamer to stop and tell its HTTP server, if any, to exit.
+        Without `force` the server shuts down gracefully, running the app's
+        lifespan shutdown.
+        """
+        if self.shutdown_flag.is_set():
+            return
+        self.shutdown_flag.set()
+        print(f"\n[server] {reason}, shutting down...")
+        if self.server is not None:
+            self.server.should_exit = True
+            self.server.force_exit = force
+        # A capture thread in idle back-off would otherwise sleep out its interval.
+        self.hub._wake.set()
+        self.interrupt_waiters()
+
+    def interrupt_waiters(self):
+        """Wake every frame waiter on every channel (used on shutdown)."""
+        self.hub.interrupt()
+        for channel in self.regions.channels():
+            channel.interrupt()
+
+    # ---- regions ----
+
+    def set_region(self, name: str, left: int, top: int, width: int, height: int):
+        """Add or move a named region (screen coordinates); raises ValueError."""
+        channel = self.regions.set(name, {"left": left, "top": top, "width": width, "height": height})
+        if self._running:
+            print(f"[regions] {name} -> {channel.box}")
+
+    def remove_region(self, name: str) -> bool:
+        return self.regions.remove(name)
+
+    # ---- frames ----
+
+    def _channel(self, region: str | None) -> FrameChannel:
+        if not self._running:
+            raise RuntimeError("ScreenStreamer is not running; call start() first")
+        if region is None:
+            return self.hub
+        channel = self.regions.get(region)
+        if channel is None:
+            raise KeyError(f"unknown region {region!r}")
+        return channel
+
+    def latest_frame(self, region: str | None = None) -> Frame | None:
+        """The newest published frame of the main region (or a named one), without waiting."""
+        return self._channel(region).latest()
+
+    def wait_frame(self, after_seq: int = 0, timeout: float = SNAPSHOT_TIMEOUT, region: str | None = None) -> Frame | None:
+        """
+        Block until a frame newer than after_seq exists; None on timeout or
+        when capture is not running (no background capture, no frames() loop).
+        """
+        return self._channel(region).wait_for_frame(after_seq, timeout)
+
+    async def frames(self, region: str | None = None, fps: float | None = None):
+        """
+        Yield frames as they are captured, at most `fps` per second (default
+        and cap: the configured fps). Ends on stop(), when the region is
+        removed or when capture fails.
+        """
+        channel = self._channel(region)
+        rate = self.hub.clamp_rate(fps)
+        loop = asyncio.get_running_loop()
+        entry = (loop, loop.create_future())
+        self._stops.append(entry)
+        self.hub.subscribe(rate)
         try:
-            signal.signal(sig, _handle_signal)
-        except (ValueError, AttributeError):
-            # Signals may not be available (e.g., on some platforms/threads); ignore.
-            pass
+            async for frame in paced_frames(channel, rate, entry[1]):
+                yield frame
+        finally:
+            self.hub.unsubscribe(rate)
+            self._stops.remove(entry)
+
+    # ---- delta encoders ----
+
+    def acquire_delta_encoder(self, view: ViewSpec, channel: str = "") -> DeltaEncoder:
+        settings = self.settings
+        with self._delta_lock:
+            encoder = self._delta_encoders.get((channel, view))
+            if encoder is None:
+                encoder = DeltaEncoder(settings.tile_size, settings.keyframe_interval, view, self.pipeline)
+                encoder.channel = channel
+                self._delta_encoders[(channel, view)] = encoder
+            encoder.acquire()
+        # Frames are only published on change: start from the current one (a
+        # keyframe) so a client joining an idle screen is not left without one.
+        source = self.regions.get(channel) if channel else self.hub
+        frame = source.latest() if source is not None else None
+        if frame is not None:
+            encoder.update(frame, seed=True)
+        return encoder
+
+    def release_delta_encoder(self, encoder: DeltaEncoder):
+        key = (encoder.channel, encoder.view)
+        with self._delta_lock:
+            if encoder.release() == 0 and self._delta_encoders.get(key) is encoder:
+                del self._delta_encoders[key]
+
+    def update_delta_encoders(self, frame: Frame):
+        with self._delta_lock:
+            encoders = [encoder for (channel, _), encoder in self._delta_encoders.items() if channel == frame.channel]
+        for encoder in encoders:
+            encoder.update(frame)
+
+    # ---- metrics ----
+
+    def collect_metrics(self) -> dict:
+        hub = self.hub
+        metrics = self.metrics
+        process_encoder = self.pipeline.process_encoder
+        now = time.time()
+        frame = hub.latest()
+        with self._delta_lock:
+            delta_bytes = sum(encoder.nbytes for encoder in self._delta_encoders.values())
+        return {
+            "target_fps": self.settings.target_fps,
+            "capture_fps": round(Metrics.rate(metrics.grab_times), 3),
+            "publish_fps": round(Metrics.rate(metrics.publish_times), 3),
+            "capture_interval_seconds": hub.capture_interval,
+            "capture_rate_fps": hub.rate(),
+            "grab_intervals": metrics.grab_intervals.snapshot(hub.capture_interval),
+            "latest_frame_seq": frame.seq if frame is not None else 0,
+            "latest_frame_age_seconds": round(now - frame.ts, 3) if frame is not None else None,
+            "last_grab_age_seconds": round(now - hub.last_grab_ts, 3) if hub.last_grab_ts else None,
+            "bytes_sent": metrics.bytes_sent,
+            "frames_sent": metrics.frames_sent,
+            "frames_dropped": metrics.frames_dropped,
+            "mjpeg_streams": self.mjpeg_streams,
+            "buffer_bytes": {
+                "latest": frame.pixels.nbytes if frame is not None else 0,
+                "history": self.history.nbytes,
+                "delta": delta_bytes,
+                "cache": self.pipeline.cache.nbytes,
+                "encode_slots": process_encoder.nbytes if process_encoder is not None else 0,
+            },
+            "stages": {stage: hist.snapshot() for stage, hist in metrics.stages.items()},
+            "clients": [client.stats() for client in self.ws_clients.values()],
+            "recorder": self.recorder.stats() if self.recorder is not None else None,
+        }
+
+    # ---- HTTP ----
+
+    def create_app(self):
+        """A FastAPI app serving this streamer (see screen_stream_http)."""
+        from screen_stream_http import create_app
+
+        return create_app(self)
+
+    def serve(self, host: str | None = None, port: int | None = None):
+        """Start capture and run the HTTP server until Ctrl+C/SIGTERM (blocking)."""
+        from screen_stream_http import make_server
+
+        host = host or self.options.host
+        port = port or self.options.port
+        self.options.host, self.options.port = host, port
+        print(f"[server] starting on http://{host}:{port}")
+        print("[server] Press Ctrl+C to exit")
+        self.start()
+        self.server = make_server(self, host, port)
 
+        # Custom signal handlers ensure Ctrl+C/SIGTERM always request shutdown,
+        # even while a websocket capture loop is running.
+        def _handle_signal(sig_num, _frame):
+            sig_name = signal.Signals(sig_num).name
+            self.request_shutdown(f"signal {sig_name} received")
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                signal.signal(sig, _handle_signal)
+            except (ValueError, AttributeError):
+                # Signals may not be available (e.g., on some platforms/threads); ignore.
+                pass
+
+        try:
+            if self.settings.use_overlay:
+                server_thread = threading.Thread(target=self.server.run, daemon=True)
+                server_thread.start()
+                run_overlay_window(self)
+                server_thread.join(timeout=2.0)
+            else:
+                self.server.run()
+        finally:
+            self.shutdown_flag.set()
+            self.stop()
+            self.server = None
+            print("[server] Server stopped")
+
+
+def main():
+    options = parser.parse_args()
     try:
-        if USE_OVERLAY:
-            server_thread = threading.Thread(target=uvicorn_server.run, daemon=True)
-            server_thread.start()
-            run_overlay_window()
-            server_thread.join(timeout=2.0)
-        else:
-            uvicorn_server.run()
-    finally:
-        shutdown_flag.set()
-        print("[server] Server stopped")
+        streamer = ScreenStreamer.from_args(options)
+    except ValueError as exc:
+        parser.error(f"--region: {exc}")
+    streamer.serve()
+
+
+if __name__ == "__main__":
+    # Run from the importable module so screen_stream_http, which imports
+    # screen_stream, shares its classes instead of loading a second copy.
+    import screen_stream
+
+    screen_stream.main()
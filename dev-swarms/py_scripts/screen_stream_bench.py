@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Headless benchmark for the screen_stream pipeline.
+
+Runs on a synthetic frame source, so it needs no display. For each
+resolution it times the individual stages (change check, BGRA->RGBA
+convert, downscale, every available codec, delta tiles) and then drives
+the real /ws endpoint end to end to measure delivered frames/sec and send
+cost. The encode-pool run compares image encode throughput with threads
+only against shared-memory worker processes (--encode-processes), which
+is where the encode-bound FPS ceiling of large frames moves. Results are
+written as JSON so runs can be diffed for regressions.
+
+    python screen_stream_bench.py --output bench.json
+    python screen_stream_bench.py --resolutions 1080p,4k --seconds 1
+    python screen_stream_bench.py --resolutions 4k --encode-processes 0,2,4,8
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+with contextlib.redirect_stdout(sys.stderr):  # keep stdout for the JSON report
+    import screen_stream as ss
+
+# The pipeline settings a default run of screen_stream.py would use.
+DEFAULTS = ss.Settings(ss.parser.parse_args([]))
+
+RESOLUTIONS = {
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "1440p": (2560, 1440),
+    "4k": (3840, 2160),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the screen_stream pipeline on synthetic frames.")
+    parser.add_argument(
+        "--resolutions",
+        default=",".join(RESOLUTIONS),
+        help=f"Comma-separated list from {', '.join(RESOLUTIONS)} or WIDTHxHEIGHT (default: all).",
+    )
+    parser.add_argument(
+        "--seconds",
+        type=float,
+        default=0.5,
+        help="Time budget per measurement (default: 0.5).",
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=75,
+        help="JPEG/WebP quality (default: 75).",
+    )
+    parser.add_argument(
+        "--pipeline-codecs",
+        default="raw,jpeg,delta",
+        help="/ws codecs driven end to end (default: raw,jpeg,delta). Empty skips the pipeline run.",
+    )
+    parser.add_argument(
+        "--encode-processes",
+        default=f"0,{os.cpu_count() or 1}",
+        help="Comma-separated worker process counts for the encode-pool run; 0 means threads only "
+        "(default: 0,<cpus>). Empty skips it.",
+    )
+    parser.add_argument(
+        "--pool-codec",
+        default="jpeg",
+        choices=["png", "jpeg", "webp"],
+        help="Codec for the encode-pool run (default: jpeg).",
+    )
+    parser.add_argument(
+        "--fps",
+        type=int,
+        default=240,
+        help="Capture rate cap for the end-to-end run (default: 240).",
+    )
+    parser.add_argument(
+        "--output",
+        default="-",
+        help="JSON output path, '-' for stdout (default).",
+    )
+    return parser.parse_args()
+
+
+def parse_resolution(name: str) -> tuple[int, int]:
+    name = name.strip().lower()
+    if name in RESOLUTIONS:
+        return RESOLUTIONS[name]
+    width, _, height = name.partition("x")
+    return int(width), int(height)
+
+
+def measure(fn, seconds: float, min_runs: int = 3) -> dict:
+    """Call fn repeatedly for about `seconds`; report per-call latency in ms."""
+    fn()  # warm-up
+    samples = []
+    deadline = time.perf_counter() + seconds
+    while len(samples) < min_runs or time.perf_counter() < deadline:
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    samples = np.array(samples) * 1000.0
+    mean = float(samples.mean())
+    return {
+        "runs": len(samples),
+        "mean_ms": round(mean, 3),
+        "p50_ms": round(float(np.percentile(samples, 50)), 3),
+        "p95_ms": round(float(np.percentile(samples, 95)), 3),
+        "per_sec": round(1000.0 / mean, 1) if mean > 0 else None,
+    }
+
+
+def make_frame(source: ss.SyntheticSource, seq: int) -> ss.Frame:
+    raw, width, height = source.grab(source.region())
+    pixels = np.frombuffer(raw, dtype=np.uint8).reshape(height, width, 4)
+    pixels.flags.writeable = False
+    return ss.Frame(seq, time.time(), width, height, pixels)
+
+
+def bench_stages(width: int, height: int, seconds: float, quality: int) -> dict:
+    source = ss.SyntheticSource(width, height, "moving")
+    frame = make_frame(source, 1)
+    pipeline = ss.EncodePipeline(ss.Metrics())
+    stages = {}
+
+    stages["grab.synthetic"] = measure(lambda: source.grab(source.region()), seconds)
+    # Worst case of the capture loop's memcmp: two equal buffers, compared to the end.
+    still, _, _ = ss.SyntheticSource(width, height, "static").grab({})
+    still_copy = bytearray(still)
+    stages["change_check"] = measure(lambda: still == still_copy, seconds)
+    stages["convert.rgba"] = measure(lambda: ss.bgra_to_rgba(frame.pixels), seconds)
+    half = (width // 2, height // 2)
+    stages["convert.scale_0.5"] = measure(lambda: ss.area_downscale(frame.pixels, (0, 0, width, height), half), seconds)
+
+    # _encode is the uncached path; bgra skips the swizzle measured above.
+    for codec in ss.available_codecs():
+        if codec in ("raw", "delta"):
+            continue
+        result = measure(lambda: pipeline._encode(frame, codec, quality, "bgra"), seconds)
+        result["bytes"] = len(pipeline._encode(frame, codec, quality, "bgra"))
+        stages[f"encode.{codec}"] = result
+
+    encoder = ss.DeltaEncoder(DEFAULTS.tile_size, DEFAULTS.keyframe_interval, ss.FULL_VIEW, pipeline)
+    encoder.acquire()
+    frames = [make_frame(source, seq) for seq in range(3, 11)]
+    state = {"index": 0, "seq": 2, "bytes": 0}
+
+    def delta_step():
+        current = frames[state["index"] % len(frames)]
+        state["index"] += 1
+        state["seq"] += 1
+        encoder.update(ss.Frame(state["seq"], time.time(), width, height, current.pixels))
+        _, payload = encoder.encode(state["seq"] - 1, "bgra")
+        state["bytes"] = len(payload)
+
+    encoder.update(frame)
+    stages["delta"] = measure(delta_step, seconds)
+    stages["delta"]["bytes"] = state["bytes"]
+    encoder.release()
+    return stages
+
+
+def bench_encode_pool(width: int, height: int, codec: str, quality: int, pools: dict, seconds: float) -> dict:
+    """
+    Encode throughput with enough frames in flight to keep every worker busy,
+    as the /ws and snapshot paths do when several clients are connected.
+    """
+    frame = make_frame(ss.SyntheticSource(width, height, "moving"), 1)
+    results = {}
+    for processes, pool in pools.items():
+        if pool is None:
+            def encode():
+                return ss.encode_image(frame.pixels, codec, quality)
+        else:
+            def encode():
+                return pool.encode(frame.pixels, codec, quality)
+        concurrency = max(processes, DEFAULTS.encode_workers)
+        encode()  # warm-up (and slot allocation)
+        deadline = time.perf_counter() + seconds
+
+        def worker(_):
+            count = 0
+            while count == 0 or time.perf_counter() < deadline:
+                encode()
+                count += 1
+            return count
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            encoded = sum(executor.map(worker, range(concurrency)))
+        elapsed = time.perf_counter() - started
+        name = f"processes_{processes}" if processes else "threads"
+        results[name] = {"workers": concurrency, "fps": round(encoded / elapsed, 1)}
+    return results
+
+
+def wait_for_capture_stop(streamer: ss.ScreenStreamer, timeout: float = 5.0):
+    deadline = time.time() + timeout
+    while streamer.hub._thread is not None and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def bench_pipeline(width: int, height: int, codecs: list[str], seconds: float, quality: int, fps: int) -> dict:
+    """Drive /ws through the ASGI test client; the capture thread runs on a synthetic source."""
+    try:
+        from fastapi.testclient import TestClient
+    except ImportError as exc:  # needs fastapi and httpx
+        return {"skipped": str(exc)}
+
+    streamer = ss.ScreenStreamer(source="synthetic", width=width, height=height, fps=fps, background=False)
+    metrics = streamer.metrics
+    results = {}
+    with TestClient(streamer.create_app()) as client:
+        for codec in codecs:
+            wait_for_capture_stop(streamer)
+            send_before = metrics.stages["send"].snapshot()
+            dropped_before = metrics.frames_dropped
+            url = f"/ws?codec={codec}&pixel_format=bgra&quality={quality}"
+            with client.websocket_connect(url) as ws:
+                init = json.loads(ws.receive_text())
+                ws.receive_bytes()  # first frame, includes capture start-up
+                first_seq = streamer.hub.latest().seq
+                received = 0
+                payload_bytes = 0
+                started = time.perf_counter()
+                while time.perf_counter() - started < seconds:
+                    payload_bytes += len(ws.receive_bytes())
+                    received += 1
+                elapsed = time.perf_counter() - started
+                published = streamer.hub.latest().seq - first_seq
+                stats = streamer.collect_metrics()
+            send = stats["stages"]["send"]
+            send_count = send["count"] - send_before["count"]
+            send_sum = send["sum"] - send_before["sum"]
+            results[init["codec"]] = {
+                "fps": round(received / elapsed, 1),
+                "capture_fps": round(published / elapsed, 1),
+                "mbit_per_sec": round(payload_bytes * 8 / elapsed / 1e6, 1),
+                "send_mean_ms": round(send_sum / send_count * 1000.0, 3) if send_count else None,
+                "dropped": stats["frames_dropped"] - dropped_before,
+            }
+    wait_for_capture_stop(streamer)
+    return results
+
+
+def main():
+    args = parse_args()
+    codecs = [codec for codec in args.pipeline_codecs.split(",") if codec]
+    process_counts = [max(0, int(count)) for count in args.encode_processes.split(",") if count.strip()]
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "encode_workers": DEFAULTS.encode_workers,
+            "encode_processes": process_counts,
+            "tile_size": DEFAULTS.tile_size,
+            "codecs": ss.available_codecs(),
+        },
+        "seconds": args.seconds,
+        "quality": args.quality,
+        "results": [],
+    }
+    with contextlib.redirect_stdout(sys.stderr):
+        pools = {}
+        for count in process_counts:
+            pools[count] = ss.ProcessEncodePool(count) if count else None
+            if pools[count] is not None:
+                pools[count].start()
+        for name in args.resolutions.split(","):
+            width, height = parse_resolution(name)
+            print(f"[bench] {name.strip()} ({width}x{height})")
+            entry = {
+                "resolution": name.strip(),
+                "width": width,
+                "height": height,
+                "stages": bench_stages(width, height, args.seconds, args.quality),
+            }
+            if pools:
+                entry["encode_pool"] = {
+                    "codec": args.pool_codec,
+                    **bench_encode_pool(width, height, args.pool_codec, args.quality, pools, args.seconds),
+                }
+            if codecs:
+                entry["pipeline"] = bench_pipeline(width, height, codecs, args.seconds, args.quality, args.fps)
+            report["results"].append(entry)
+        for pool in pools.values():
+            if pool is not None:
+                pool.shutdown()
+
+    text = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as fh:
+            fh.write(text + "\n")
+        print(f"[bench] wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
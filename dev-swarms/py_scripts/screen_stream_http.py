@@ -0,0 +1,1202 @@
+#!/usr/bin/env python3
+"""
+HTTP layer of screen_stream: the WebGL viewer, /ws, /stream.mjpg,
+snapshots, regions, frame history, replay and /metrics for one
+ScreenStreamer. screen_stream only imports this module to serve or build
+an app, so the in-process capture API works without fastapi and uvicorn.
+
+    app = create_app(ScreenStreamer(source="synthetic"))
+"""
+import asyncio
+import json
+import signal
+import time
+import zlib
+from contextlib import asynccontextmanager
+
+import uvicorn
+from fastapi import APIRouter, Depends, FastAPI, Header, WebSocket, WebSocketDisconnect
+from fastapi.requests import HTTPConnection
+from fastapi.responses import HTMLResponse, PlainTextResponse, Response, StreamingResponse
+
+from screen_stream import (
+    IMAGE_FORMATS,
+    MAX_WAIT_TIMEOUT,
+    SNAPSHOT_TIMEOUT,
+    Frame,
+    FrameChannel,
+    IntervalStats,
+    ScreenStreamer,
+    ViewSpec,
+    available_codecs,
+    format_prometheus,
+    negotiate_codec,
+    paced_frames,
+)
+
+router = APIRouter()
+
+
+def current_streamer(conn: HTTPConnection) -> ScreenStreamer:
+    return conn.app.state.streamer
+
+
+def create_app(streamer: ScreenStreamer) -> FastAPI:
+    """
+    The HTTP API of one streamer. If the streamer is not running when the
+    app starts up, the app starts it and stops it again on shutdown.
+    """
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        owned = not streamer.running
+        if owned:
+            await asyncio.to_thread(streamer.start)
+        try:
+            yield
+        finally:
+            if owned:
+                await asyncio.to_thread(streamer.stop)
+
+    app = FastAPI(lifespan=lifespan)
+    app.state.streamer = streamer
+    app.include_router(router)
+    return app
+
+
+class StreamServer(uvicorn.Server):
+    """
+    uvicorn server whose own signal handling also wakes the streamer's frame
+    waiters and capture thread. uvicorn still decides how to exit: the first
+    signal shuts down gracefully, a second Ctrl+C forces it.
+    """
+
+    def __init__(self, config: uvicorn.Config, streamer: ScreenStreamer):
+        super().__init__(config)
+        self.streamer = streamer
+
+    def handle_exit(self, sig, frame):
+        super().handle_exit(sig, frame)
+        self.streamer.request_shutdown(f"signal {signal.Signals(sig).name} received", force=False)
+
+
+def make_server(streamer: ScreenStreamer, host: str, port: int) -> StreamServer:
+    config = uvicorn.Config(
+        create_app(streamer),
+        host=host,
+        port=port,
+        log_level="info",
+        timeout_keep_alive=5,
+        reload=False,
+    )
+    return StreamServer(config, streamer)
+
+
+@router.get("/")
+async def index():
+    """
+    Returns HTML page with a <canvas> that uses WebGL.
+    It connects to /ws (tile delta codec unless ?codec= says otherwise),
+    decodes jpeg/webp/zlib frames with browser-native decoders and draws
+    the result as a texture.
+    """
+    return HTMLResponse(VIEWER_HTML)
+
+
+@router.websocket("/ws")
+async def websocket_endpoint(
+    ws: WebSocket,
+    codec: str = "raw",
+    quality: int = 75,
+    pixel_format: str = "rgba",
+    scale: float = 1.0,
+    max_side: int = 0,
+    crop: str | None = None,
+    fps: float = 0,
+    streamer: ScreenStreamer = Depends(current_streamer),
+):
+    """
+    Streams frames published by the shared capture hub.
+    - Subscribing starts the capture thread if this is the first consumer.
+    - Unsubscribing on disconnect lets it stop once nobody is watching.
+    - codec is a preference list (e.g. "zstd,zlib,raw"); the init message
+      reports the one chosen. raw/zlib/zstd carry RGBA pixels, jpeg/webp
+      carry images at `quality`, delta sends changed tiles only.
+    - pixel_format=bgra ships pixels in capture order with no swizzle copy;
+      the embedded viewer swaps channels in its fragment shader.
+    - crop/scale/max_side shrink the stream server-side (see ViewSpec).
+    - fps sets this client's rate (default and maximum: --fps). Capture runs
+      at the fastest rate any client asked for; slower clients get the newest
+      frame at each of their own monotonic deadlines.
+    - A slow client skips frames instead of queueing them (see WsClient).
+    """
+    await stream_channel(streamer, ws, streamer.hub, codec, quality, pixel_format, scale, max_side, crop, fps)
+
+
+@router.websocket("/regions/{name}/ws")
+async def region_websocket_endpoint(
+    ws: WebSocket,
+    name: str,
+    codec: str = "raw",
+    quality: int = 75,
+    pixel_format: str = "rgba",
+    scale: float = 1.0,
+    max_side: int = 0,
+    crop: str | None = None,
+    fps: float = 0,
+    streamer: ScreenStreamer = Depends(current_streamer),
+):
+    """
+    Same as /ws for one named region. The socket closes when the region is removed.
+    """
+    channel = streamer.regions.get(name)
+    if channel is None:
+        await ws.accept()
+        await ws.send_text(json.dumps({"type": "error", "message": f"unknown region {name!r}"}))
+        await ws.close(code=1008)
+        return
+    await stream_channel(streamer, ws, channel, codec, quality, pixel_format, scale, max_side, crop, fps)
+
+
+async def stream_channel(
+    streamer: ScreenStreamer,
+    ws: WebSocket,
+    channel: FrameChannel,
+    codec: str,
+    quality: int,
+    pixel_format: str,
+    scale: float,
+    max_side: int,
+    crop: str | None,
+    fps: float,
+):
+    hub = streamer.hub
+    await ws.accept()
+    try:
+        view = ViewSpec.parse(scale, max_side, crop)
+    except ValueError as exc:
+        await ws.send_text(json.dumps({"type": "error", "message": str(exc)}))
+        await ws.close(code=1008)
+        return
+    codec = negotiate_codec(codec)
+    quality = min(100, max(1, quality)) if codec in ("jpeg", "webp") else 0
+    pixel_format = "bgra" if pixel_format.lower() == "bgra" else "rgba"
+    fps = hub.clamp_rate(fps)
+    client = WsClient(streamer, ws, codec, quality, pixel_format, view, fps)
+    client.channel = channel.name
+    print(f"[ws] client {client.id} connected (codec={codec}, fps={fps:g}{', region=' + channel.name if channel.name else ''})")
+    streamer.ws_clients[client.id] = client
+    hub.subscribe(fps)
+    if client.use_delta:
+        client.delta = streamer.acquire_delta_encoder(view, channel.name)
+    sender = asyncio.create_task(client.send_loop())
+    # Nothing is sent on an idle screen, so only a read notices a closed socket.
+    receiver = asyncio.create_task(client.receive_loop())
+
+    try:
+        async for frame in paced_frames(channel, fps, sender, receiver):
+            client.offer(frame)
+        if streamer.exiting():
+            streamer.request_shutdown("server exit signaled")
+            sender.cancel()
+            await ws.close(code=1001, reason="server shutdown")
+        elif receiver.done():
+            await receiver
+        elif sender.done():
+            # Re-raises the disconnect or send error that ended the sender.
+            await sender
+        elif getattr(channel, "closed", False):
+            await ws.close(code=1000, reason="region removed")
+        elif hub.error:
+            raise RuntimeError(hub.error)
+
+    except WebSocketDisconnect:
+        print(f"[ws] client {client.id} disconnected (sent={client.sent}, dropped={client.dropped})")
+    except Exception as e:
+        print("[ws] error in capture loop:", e)
+        # Try to notify client, but ignore if already gone
+        try:
+            await ws.send_text(json.dumps({
+                "type": "error",
+                "message": f"Server error: {e}",
+            }))
+            await ws.close()
+        except Exception:
+            pass
+    finally:
+        sender.cancel()
+        receiver.cancel()
+        streamer.ws_clients.pop(client.id, None)
+        if client.delta is not None:
+            streamer.release_delta_encoder(client.delta)
+        hub.unsubscribe(fps)
+
+
+class WsClient:
+    """
+    Latest-frame-wins delivery for one /ws connection.
+
+    The pacing loop offers frames into a one-slot mailbox and a separate
+    sender task drains it. If the socket is slower than the capture rate,
+    an unsent frame is replaced by the newer one (counted as dropped), so
+    a slow tab skips frames instead of building latency. Frames whose
+    sequence number was already offered are ignored, so an idle producer
+    never causes duplicate sends. Encoding happens at send time, which
+    keeps the delta codec consistent across dropped frames.
+    """
+
+    _next_id = 1
+
+    def __init__(
+        self, streamer: ScreenStreamer, ws: WebSocket, codec: str, quality: int, pixel_format: str, view: ViewSpec, fps: float
+    ):
+        self.id = WsClient._next_id
+        WsClient._next_id += 1
+        self.streamer = streamer
+        self.ws = ws
+        self.codec = codec
+        self.quality = quality
+        self.pixel_format = pixel_format
+        self.view = view
+        self.fps = fps
+        self.intervals = IntervalStats()
+        self.channel = ""  # named region, "" for the main one
+        self.use_delta = codec == "delta"
+        self.delta = None
+        self.peer = f"{ws.client.host}:{ws.client.port}" if ws.client else None
+        self.connected_at = time.time()
+        self.sent = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        self.last_sent_seq = 0
+        self._offered_seq = 0
+        self._pending = None
+        self._ready = asyncio.Event()
+
+    def offer(self, frame: Frame):
+        if frame.seq == self._offered_seq:
+            return
+        self.intervals.tick(time.monotonic())
+        if self._pending is not None:
+            self.dropped += 1
+            self.streamer.metrics.frames_dropped += 1
+        self._pending = frame
+        self._offered_seq = frame.seq
+        self._ready.set()
+
+    async def _take(self) -> Frame:
+        await self._ready.wait()
+        self._ready.clear()
+        frame, self._pending = self._pending, None
+        return frame
+
+    async def send_loop(self):
+        pipeline = self.streamer.pipeline
+        metrics = self.streamer.metrics
+        last_size = (0, 0)
+        while True:
+            frame = await self._take()
+            if self.use_delta:
+                frame, payload = await pipeline.run(self.delta.encode, self.last_sent_seq, self.pixel_format)
+            elif frame.seq > self.last_sent_seq:
+                frame, payload = await pipeline.encode_view_async(frame, self.view, self.codec, self.quality, self.pixel_format)
+            else:
+                payload = None
+            if payload is None:
+                continue
+
+            if frame.size != last_size:
+                init_msg = {
+                    "type": "init",
+                    "width": frame.width,
+                    "height": frame.height,
+                    "codec": self.codec,
+                    "codecs": available_codecs(),
+                }
+                if self.quality:
+                    init_msg["quality"] = self.quality
+                else:
+                    init_msg["pixel_format"] = self.pixel_format
+                if self.use_delta:
+                    init_msg["tile_size"] = self.delta.tile_size
+                await self.ws.send_text(json.dumps(init_msg))
+                last_size = frame.size
+
+            started = time.perf_counter()
+            await self.ws.send_bytes(payload)
+            metrics.observe("send", time.perf_counter() - started)
+            size = payload.nbytes if isinstance(payload, memoryview) else len(payload)
+            self.sent += 1
+            self.bytes_sent += size
+            self.last_sent_seq = frame.seq
+            metrics.frames_sent += 1
+            metrics.bytes_sent += size
+
+    async def receive_loop(self):
+        """Discard client messages; raises WebSocketDisconnect when the socket closes."""
+        while True:
+            message = await self.ws.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+
+    def stats(self) -> dict:
+        return {
+            "id": self.id,
+            "peer": self.peer,
+            "codec": self.codec,
+            "quality": self.quality,
+            "pixel_format": self.pixel_format,
+            "view": self.view.describe(),
+            "region": self.channel or None,
+            "fps": self.fps,
+            "intervals": self.intervals.snapshot(1.0 / self.fps),
+            "connected_seconds": round(time.time() - self.connected_at, 3),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "bytes_sent": self.bytes_sent,
+            "last_sent_seq": self.last_sent_seq,
+        }
+
+
+MJPEG_BOUNDARY = "frame"
+
+
+async def mjpeg_response(
+    streamer: ScreenStreamer,
+    channel: FrameChannel,
+    fps: float,
+    quality: int,
+    scale: float,
+    max_side: int,
+    crop: str | None,
+) -> Response:
+    try:
+        view = ViewSpec.parse(scale, max_side, crop)
+    except ValueError as exc:
+        return Response(content=str(exc).encode("utf-8"), status_code=400, media_type="text/plain")
+    hub = streamer.hub
+    fps = hub.clamp_rate(fps)
+    quality = min(100, max(1, quality))
+
+    async def parts():
+        hub.subscribe(fps)
+        streamer.mjpeg_streams += 1
+        try:
+            async for frame in paced_frames(channel, fps):
+                # Same (frame, view, quality) as another connection: one shared encode.
+                _, data = await streamer.pipeline.encode_view_async(frame, view, "jpeg", quality)
+                header = (
+                    f"--{MJPEG_BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                    f"Content-Length: {len(data)}\r\nX-Frame-Seq: {frame.seq}\r\n\r\n"
+                )
+                yield header.encode("ascii") + data + b"\r\n"
+                streamer.metrics.frames_sent += 1
+                streamer.metrics.bytes_sent += len(data)
+        finally:
+            streamer.mjpeg_streams -= 1
+            hub.unsubscribe(fps)
+
+    return StreamingResponse(
+        parts(),
+        media_type=f"multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}",
+        headers={"Cache-Control": "no-cache, no-store", "Pragma": "no-cache"},
+    )
+
+
+@router.get("/stream.mjpg")
+async def stream_mjpg(
+    fps: float = 0,
+    quality: int = 75,
+    scale: float = 1.0,
+    max_side: int = 0,
+    crop: str | None = None,
+    streamer: ScreenStreamer = Depends(current_streamer),
+):
+    """
+    Motion JPEG (multipart/x-mixed-replace) of the shared capture for
+    consumers that cannot speak /ws: <img src>, ffmpeg, OpenCV VideoCapture.
+    fps (default and maximum: --fps), quality and crop/scale/max_side are
+    per connection; connections with the same settings share each encode.
+    """
+    return await mjpeg_response(streamer, streamer.hub, fps, quality, scale, max_side, crop)
+
+
+@router.get("/regions/{name}/stream.mjpg")
+async def region_stream_mjpg(
+    name: str,
+    fps: float = 0,
+    quality: int = 75,
+    scale: float = 1.0,
+    max_side: int = 0,
+    crop: str | None = None,
+    streamer: ScreenStreamer = Depends(current_streamer),
+):
+    """
+    /stream.mjpg for one named region; the stream ends when the region is removed.
+    """
+    channel = streamer.regions.get(name)
+    if channel is None:
+        return Response(content=f"unknown region {name!r}".encode("utf-8"), status_code=404, media_type="text/plain")
+    return await mjpeg_response(streamer, channel, fps, quality, scale, max_side, crop)
+
+
+@router.get("/clients")
+async def list_clients(streamer: ScreenStreamer = Depends(current_streamer)):
+    """
+    Per-client delivery counters for connected /ws clients.
+    """
+    return [client.stats() for client in streamer.ws_clients.values()]
+
+
+async def latest_snapshot_frame(
+    streamer: ScreenStreamer,
+    wait_for_change: bool = False,
+    since: int | None = None,
+    timeout: float = SNAPSHOT_TIMEOUT,
+    channel: FrameChannel | None = None,
+) -> tuple[Frame | None, bool, Response | None]:
+    """
+    Return (frame, changed, error response). With wait_for_change the call
+    long-polls until a frame newer than `since` (default: the latest frame
+    at request time) is captured; on timeout it returns the latest frame
+    with changed=False. `channel` picks a named region (default: the main one).
+    """
+    hub = streamer.hub
+    channel = channel or hub
+    if streamer.settings.background and not wait_for_change and channel is hub:
+        frame = hub.latest()
+        if frame is None:
+            return None, False, Response(content=b"", status_code=503, media_type="text/plain")
+        return frame, True, None
+
+    # Unchanged grabs are not published, so while the capture thread runs
+    # the latest frame is current; only a cold start has to wait for one.
+    # Its first grab keeps the old seq when nothing changed meanwhile, so it
+    # does not count as a change against `since`.
+    hub.subscribe()
+    try:
+        frame = channel.latest()
+        if frame is None:
+            frame = await channel.next_frame(0, SNAPSHOT_TIMEOUT)
+        changed = frame is not None
+        if frame is not None and wait_for_change:
+            baseline = frame.seq if since is None else since
+            frame = await channel.next_frame(baseline, timeout, urgent=True)
+            changed = frame is not None
+            if frame is None:
+                frame = channel.latest()
+    finally:
+        hub.unsubscribe()
+    if frame is None:
+        message = hub.error or "capture timed out"
+        return None, False, Response(content=message.encode("utf-8"), status_code=503, media_type="text/plain")
+    return frame, changed, None
+
+
+async def snapshot_response(
+    streamer: ScreenStreamer,
+    fmt: str,
+    quality: int,
+    scale: float,
+    max_side: int,
+    crop: str | None,
+    if_none_match: str | None,
+    wait_for_change: bool = False,
+    since: int | None = None,
+    timeout: float = SNAPSHOT_TIMEOUT,
+    channel: FrameChannel | None = None,
+) -> Response:
+    try:
+        view = ViewSpec.parse(scale, max_side, crop)
+    except ValueError as exc:
+        return Response(content=str(exc).encode("utf-8"), status_code=400, media_type="text/plain")
+    try:
+        timeout = min(MAX_WAIT_TIMEOUT, max(0.0, timeout))
+        frame, changed, error = await latest_snapshot_frame(streamer, wait_for_change, since, timeout, channel)
+        if error is not None:
+            return error
+
+        quality = min(100, max(1, quality))
+        if fmt == "png":
+            quality = 0
+        (x, y, w, h), (out_w, out_h) = view.resolve(frame.width, frame.height)
+        etag = f'"{streamer.boot_id}-{frame.channel}-{frame.seq}-{fmt}-{quality}-{x}.{y}.{w}.{h}-{out_w}x{out_h}"'
+        headers = {
+            "ETag": etag,
+            "Cache-Control": "no-cache",
+            "X-Frame-Seq": str(frame.seq),
+            "X-Frame-Changed": "1" if changed else "0",
+        }
+        if if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+
+        _, data = await streamer.pipeline.encode_view_async(frame, view, fmt, quality)
+        return Response(content=data, media_type=IMAGE_FORMATS[fmt][1], headers=headers)
+    except Exception as exc:
+        return Response(content=f"capture error: {exc}".encode("utf-8"), status_code=500, media_type="text/plain")
+
+
+@router.get("/snapshot.png")
+async def snapshot_png(
+    scale: float = 1.0,
+    max_side: int = 0,
+    crop: str | None = None,
+    wait_for_change: bool = False,
+    since: int | None = None,
+    timeout: float = SNAPSHOT_TIMEOUT,
+    if_none_match: str | None = Header(default=None),
+    streamer: ScreenStreamer = Depends(current_streamer),
+):
+    """
+    Returns a single PNG frame for preview or download.
+    crop=x,y,w,h, scale and max_side shrink it server-side before encoding.
+    Supports ETag/If-None-Match so an unchanged frame answers 304.
+    wait_for_change=1 long-polls (up to `timeout` seconds) for the next
+    visually different frame after `since` (default: the current frame);
+    X-Frame-Changed tells whether one arrived.
+    """
+    return await snapshot_response(
+        streamer, "png", 0, scale, max_side, crop, if_none_match, wait_for_change, since, timeout
+    )
+
+
+@router.get("/snapshot.jpg")
+async def snapshot_jpg(
+    scale: float = 1.0,
+    max_side: int = 0,
+    crop: str | None = None,
+    quality: int = 80,
+    wait_for_change: bool = False,
+    since: int | None = None,
+    timeout: float = SNAPSHOT_TIMEOUT,
+    if_none_match: str | None = Header(default=None),
+    streamer: ScreenStreamer = Depends(current_streamer),
+):
+    """
+    Returns a single JPEG frame (smaller than PNG for photos and video).
+    """
+    return await snapshot_response(
+        streamer, "jpeg", quality, scale, max_side, crop, if_none_match, wait_for_change, since, timeout
+    )
+
+
+@router.get("/snapshot.webp")
+async def snapshot_webp(
+    scale: float = 1.0,
+    max_side: int = 0,
+    crop: str | None = None,
+    quality: int = 80,
+    wait_for_change: bool = False,
+    since: int | None = None,
+    timeout: float = SNAPSHOT_TIMEOUT,
+    if_none_match: str | None = Header(default=None),
+    streamer: ScreenStreamer = Depends(current_streamer),
+):
+    """
+    Returns a single WebP frame.
+    """
+    return await snapshot_response(
+        streamer, "webp", quality, scale, max_side, crop, if_none_match, wait_for_change, since, timeout
+    )
+
+
+@router.get("/regions")
+async def list_regions(streamer: ScreenStreamer = Depends(current_streamer)):
+    """
+    Named regions (screen box and latest frame seq/size).
+    """
+    return [channel.describe() for channel in streamer.regions.channels()]
+
+
+@router.put("/regions/{name}")
+async def put_region(
+    name: str, left: int, top: int, width: int, height: int, streamer: ScreenStreamer = Depends(current_streamer)
+):
+    """
+    Add a named region or move/resize an existing one (screen coordinates).
+    It is captured from the same grab as the main region from the next tick.
+    """
+    try:
+        channel = streamer.regions.set(name, {"left": left, "top": top, "width": width, "height": height})
+    except ValueError as exc:
+        return Response(content=str(exc).encode("utf-8"), status_code=400, media_type="text/plain")
+    print(f"[regions] {name} -> {channel.box}")
+    return channel.describe()
+
+
+@router.delete("/regions/{name}")
+async def delete_region(name: str, streamer: ScreenStreamer = Depends(current_streamer)):
+    """
+    Remove a named region; its /ws clients are disconnected.
+    """
+    if not streamer.regions.remove(name):
+        return Response(content=f"unknown region {name!r}".encode("utf-8"), status_code=404, media_type="text/plain")
+    print(f"[regions] {name} removed")
+    return Response(status_code=204)
+
+
+@router.get("/regions/{name}/snapshot.{ext}")
+async def region_snapshot(
+    name: str,
+    ext: str,
+    scale: float = 1.0,
+    max_side: int = 0,
+    crop: str | None = None,
+    quality: int = 80,
+    wait_for_change: bool = False,
+    since: int | None = None,
+    timeout: float = SNAPSHOT_TIMEOUT,
+    if_none_match: str | None = Header(default=None),
+    streamer: ScreenStreamer = Depends(current_streamer),
+):
+    """
+    Single frame of a named region as png, jpg or webp; same parameters as /snapshot.*.
+    """
+    fmt = {"png": "png", "jpg": "jpeg", "jpeg": "jpeg", "webp": "webp"}.get(ext.lower())
+    if fmt is None:
+        return Response(content=f"unsupported format {ext!r}".encode("utf-8"), status_code=404, media_type="text/plain")
+    channel = streamer.regions.get(name)
+    if channel is None:
+        return Response(content=f"unknown region {name!r}".encode("utf-8"), status_code=404, media_type="text/plain")
+    return await snapshot_response(
+        streamer, fmt, quality, scale, max_side, crop, if_none_match, wait_for_change, since, timeout, channel
+    )
+
+
+@router.get("/frames")
+async def list_frames(since: int = 0, streamer: ScreenStreamer = Depends(current_streamer)):
+    """
+    Lists frames still held in the history ring, oldest first.
+    Poll with since=<last seen seq> to get only newer entries.
+    """
+    now = time.time()
+    frames = streamer.history.list(since)
+    for entry in frames:
+        entry["age"] = round(now - entry["ts"], 3)
+    return {"frames": frames, "history": streamer.history.stats()}
+
+
+@router.get("/frame/{seq}.png")
+async def frame_png(
+    seq: int,
+    scale: float = 1.0,
+    max_side: int = 0,
+    crop: str | None = None,
+    streamer: ScreenStreamer = Depends(current_streamer),
+):
+    """
+    Returns one frame from the history ring as PNG (404 once evicted).
+    Accepts the same crop/scale/max_side parameters as /snapshot.png.
+    """
+    try:
+        view = ViewSpec.parse(scale, max_side, crop)
+    except ValueError as exc:
+        return Response(content=str(exc).encode("utf-8"), status_code=400, media_type="text/plain")
+    frame = streamer.history.get(seq)
+    if frame is None:
+        return Response(content=f"frame {seq} is not in the history".encode("utf-8"), status_code=404, media_type="text/plain")
+    _, data = await streamer.pipeline.encode_view_async(frame, view, "png")
+    # A sequence number always names the same pixels for this streamer.
+    headers = {"ETag": f'"{streamer.boot_id}-{seq}-history"', "Cache-Control": "private, max-age=3600, immutable"}
+    return Response(content=data, media_type="image/png", headers=headers)
+
+
+def recording_off() -> Response:
+    return Response(content=b"recording is off (start with --record DIR)", status_code=404, media_type="text/plain")
+
+
+async def replay_response(
+    streamer: ScreenStreamer, found: tuple[str, int] | None, fmt: str, quality: int, view: ViewSpec
+) -> Response:
+    if found is None:
+        return Response(content=b"no recorded frame matches", status_code=404, media_type="text/plain")
+    try:
+        frame = await asyncio.to_thread(streamer.recorder.read, *found)
+    except (OSError, ValueError, RuntimeError, zlib.error) as exc:
+        return Response(content=f"replay error: {exc}".encode("utf-8"), status_code=500, media_type="text/plain")
+    quality = 0 if fmt == "png" else min(100, max(1, quality))
+    _, data = await streamer.pipeline.encode_view_async(frame, view, fmt, quality)
+    headers = {
+        "X-Frame-Seq": str(frame.seq),
+        "X-Frame-Time": f"{frame.ts:.3f}",
+        "Cache-Control": "private, max-age=3600, immutable",
+    }
+    return Response(content=data, media_type=IMAGE_FORMATS[fmt][1], headers=headers)
+
+
+@router.get("/replay/index")
+async def replay_index(streamer: ScreenStreamer = Depends(current_streamer)):
+    """
+    Recorded segments (seq and time ranges) and recorder counters.
+    """
+    recorder = streamer.recorder
+    if recorder is None:
+        return recording_off()
+    return {"segments": await asyncio.to_thread(recorder.segments), "recorder": recorder.stats()}
+
+
+@router.get("/replay")
+async def replay_at(
+    t: float,
+    format: str = "png",
+    quality: int = 80,
+    scale: float = 1.0,
+    max_side: int = 0,
+    crop: str | None = None,
+    streamer: ScreenStreamer = Depends(current_streamer),
+):
+    """
+    The recorded frame showing at time t: unix seconds, or seconds ago
+    when negative (t=-30 is half a minute back). format is png, jpg or
+    webp; crop/scale/max_side as for /snapshot.png. X-Frame-Time gives
+    the capture time of the frame returned.
+    """
+    if streamer.recorder is None:
+        return recording_off()
+    fmt = {"png": "png", "jpg": "jpeg", "jpeg": "jpeg", "webp": "webp"}.get(format.lower())
+    if fmt is None:
+        return Response(content=f"unsupported format {format!r}".encode("utf-8"), status_code=400, media_type="text/plain")
+    try:
+        view = ViewSpec.parse(scale, max_side, crop)
+    except ValueError as exc:
+        return Response(content=str(exc).encode("utf-8"), status_code=400, media_type="text/plain")
+    if t < 0:
+        t += time.time()
+    found = await asyncio.to_thread(streamer.recorder.find_time, t)
+    return await replay_response(streamer, found, fmt, quality, view)
+
+
+@router.get("/replay/{seq}.png")
+async def replay_png(
+    seq: int,
+    scale: float = 1.0,
+    max_side: int = 0,
+    crop: str | None = None,
+    streamer: ScreenStreamer = Depends(current_streamer),
+):
+    """
+    A recorded frame by capture seq as PNG. Seqs restart with each run;
+    the newest recording of this seq wins.
+    """
+    if streamer.recorder is None:
+        return recording_off()
+    try:
+        view = ViewSpec.parse(scale, max_side, crop)
+    except ValueError as exc:
+        return Response(content=str(exc).encode("utf-8"), status_code=400, media_type="text/plain")
+    found = await asyncio.to_thread(streamer.recorder.find_seq, seq)
+    return await replay_response(streamer, found, "png", 0, view)
+
+
+@router.get("/metrics")
+async def metrics_endpoint(format: str = "prometheus", streamer: ScreenStreamer = Depends(current_streamer)):
+    """
+    Pipeline health: per-stage latency histograms (grab, convert, delta,
+    encode, send), achieved vs target FPS, frame ages, bytes and frames
+    sent or dropped per client and memory held by frame buffers.
+    Prometheus text by default, JSON with ?format=json.
+    """
+    data = streamer.collect_metrics()
+    if format == "json":
+        for hist in data["stages"].values():
+            hist["buckets"] = [["+Inf" if bound == float("inf") else bound, count] for bound, count in hist["buckets"]]
+        return data
+    return PlainTextResponse(format_prometheus(data), media_type="text/plain; version=0.0.4")
+
+
+VIEWER_HTML = r"""
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>Local Screen Region Viewer (WebGL)</title>
+    <style>
+        body {
+            margin: 0;
+            background: #000;
+            display: flex;
+            height: 100vh;
+            overflow: hidden;
+        }
+        #canvas-wrapper {
+            flex: 1;
+            display: flex;
+            justify-content: center;
+            align-items: center;
+            background: #000;
+        }
+        canvas {
+            background: #000;
+            max-width: 100%;
+            max-height: 100%;
+        }
+    </style>
+</head>
+<body>
+<div id="canvas-wrapper">
+    <canvas id="screenCanvas"></canvas>
+</div>
+
+<script>
+(function () {
+    const canvas = document.getElementById("screenCanvas");
+
+    // ---------- WebGL SETUP ----------
+
+    /** @type {WebGLRenderingContext} */
+    const gl = canvas.getContext("webgl", { preserveDrawingBuffer: true });
+    if (!gl) {
+        console.error("WebGL not supported in this environment.");
+        return;
+    }
+
+    function resizeCanvasToDisplaySize() {
+        if (!initialized || frameWidth === 0 || frameHeight === 0) {
+            return;
+        }
+
+        const parent = canvas.parentElement;
+        const containerWidth = parent.clientWidth;
+        const containerHeight = parent.clientHeight;
+
+        // Calculate aspect ratios
+        const sourceAspect = frameWidth / frameHeight;
+        const containerAspect = containerWidth / containerHeight;
+
+        let canvasWidth, canvasHeight;
+
+        // Fit the canvas within the container while maintaining aspect ratio
+        if (sourceAspect > containerAspect) {
+            // Source is wider than container - fit to width
+            canvasWidth = containerWidth;
+            canvasHeight = containerWidth / sourceAspect;
+        } else {
+            // Source is taller than container - fit to height
+            canvasHeight = containerHeight;
+            canvasWidth = containerHeight * sourceAspect;
+        }
+
+        if (canvas.width !== canvasWidth || canvas.height !== canvasHeight) {
+            canvas.width = canvasWidth;
+            canvas.height = canvasHeight;
+            gl.viewport(0, 0, canvas.width, canvas.height);
+        }
+    }
+    window.addEventListener("resize", resizeCanvasToDisplaySize);
+
+    const vertexShaderSource = `
+        attribute vec2 a_position;
+        attribute vec2 a_texCoord;
+        varying vec2 v_texCoord;
+
+        void main() {
+            gl_Position = vec4(a_position, 0.0, 1.0);
+            v_texCoord = a_texCoord;
+        }
+    `;
+
+    const fragmentShaderSource = `
+        precision mediump float;
+        varying vec2 v_texCoord;
+        uniform sampler2D u_texture;
+        uniform bool u_swapRB;
+
+        void main() {
+            vec4 color = texture2D(u_texture, v_texCoord);
+            gl_FragColor = u_swapRB ? color.bgra : color;
+        }
+    `;
+
+    function createShader(gl, type, source) {
+        const shader = gl.createShader(type);
+        gl.shaderSource(shader, source);
+        gl.compileShader(shader);
+        if (!gl.getShaderParameter(shader, gl.COMPILE_STATUS)) {
+            console.error("Shader compile failed:", gl.getShaderInfoLog(shader));
+            gl.deleteShader(shader);
+            return null;
+        }
+        return shader;
+    }
+
+    function createProgram(gl, vsSource, fsSource) {
+        const vs = createShader(gl, gl.VERTEX_SHADER, vsSource);
+        const fs = createShader(gl, gl.FRAGMENT_SHADER, fsSource);
+        const program = gl.createProgram();
+        gl.attachShader(program, vs);
+        gl.attachShader(program, fs);
+        gl.linkProgram(program);
+        if (!gl.getProgramParameter(program, gl.LINK_STATUS)) {
+            console.error("Program link failed:", gl.getProgramInfoLog(program));
+            gl.deleteProgram(program);
+            return null;
+        }
+        return program;
+    }
+
+    const program = createProgram(gl, vertexShaderSource, fragmentShaderSource);
+    gl.useProgram(program);
+
+    const positionLocation = gl.getAttribLocation(program, "a_position");
+    const texCoordLocation = gl.getAttribLocation(program, "a_texCoord");
+    const textureLocation  = gl.getUniformLocation(program, "u_texture");
+    const swapRBLocation   = gl.getUniformLocation(program, "u_swapRB");
+
+    // Full-screen quad
+    const positionBuffer = gl.createBuffer();
+    gl.bindBuffer(gl.ARRAY_BUFFER, positionBuffer);
+    const positions = new Float32Array([
+        -1, -1,
+         1, -1,
+        -1,  1,
+         1,  1,
+    ]);
+    gl.bufferData(gl.ARRAY_BUFFER, positions, gl.STATIC_DRAW);
+
+    // Texture coords
+    const texCoordBuffer = gl.createBuffer();
+    gl.bindBuffer(gl.ARRAY_BUFFER, texCoordBuffer);
+    const texCoords = new Float32Array([
+        0, 1,
+        1, 1,
+        0, 0,
+        1, 0,
+    ]);
+    gl.bufferData(gl.ARRAY_BUFFER, texCoords, gl.STATIC_DRAW);
+
+    // Setup attributes
+    gl.bindBuffer(gl.ARRAY_BUFFER, positionBuffer);
+    gl.enableVertexAttribArray(positionLocation);
+    gl.vertexAttribPointer(positionLocation, 2, gl.FLOAT, false, 0, 0);
+
+    gl.bindBuffer(gl.ARRAY_BUFFER, texCoordBuffer);
+    gl.enableVertexAttribArray(texCoordLocation);
+    gl.vertexAttribPointer(texCoordLocation, 2, gl.FLOAT, false, 0, 0);
+
+    // Texture
+    const texture = gl.createTexture();
+    gl.bindTexture(gl.TEXTURE_2D, texture);
+
+    gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_MIN_FILTER, gl.LINEAR);
+    gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_MAG_FILTER, gl.LINEAR);
+    gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_S, gl.CLAMP_TO_EDGE);
+    gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_T, gl.CLAMP_TO_EDGE);
+
+    gl.uniform1i(textureLocation, 0);
+
+    // ---------- WEBSOCKET / FRAME HANDLING ----------
+
+    let frameWidth = 0;
+    let frameHeight = 0;
+    let initialized = false;
+    let codec = "raw";
+    let tileSize = 0;
+    let tilesX = 0;
+    let haveKeyframe = false;
+
+    // Delta envelope header: seq (u32), tile count (u32), tile size (u16), flags (u16)
+    const DELTA_HEADER_BYTES = 12;
+    const DELTA_FLAG_KEYFRAME = 1;
+    const IMAGE_TYPES = { jpeg: "image/jpeg", webp: "image/webp" };
+
+    // The page's own query string (e.g. ?codec=jpeg&quality=60) is forwarded
+    // to /ws. zstd has no browser-native decoder, so the viewer never asks for it.
+    const params = new URLSearchParams(location.search);
+    const requested = (params.get("codec") || "delta")
+        .split(",")
+        .filter((name) => name.trim() !== "zstd");
+    params.set("codec", requested.length ? requested.join(",") : "delta");
+    // Pixels arrive in capture (BGRA) order; the fragment shader swaps them.
+    if (!params.has("pixel_format")) {
+        params.set("pixel_format", "bgra");
+    }
+
+    const wsProtocol = (location.protocol === "https:") ? "wss" : "ws";
+    const wsUrl = wsProtocol + "://" + location.host + "/ws?" + params.toString();
+    const ws = new WebSocket(wsUrl);
+    ws.binaryType = "arraybuffer";
+
+    function setupTexture() {
+        // Delta tiles are always tileSize x tileSize, so the texture is padded
+        // to whole tiles and the quad only samples the visible part of it.
+        let texWidth = frameWidth;
+        let texHeight = frameHeight;
+        if (codec === "delta") {
+            tilesX = Math.ceil(frameWidth / tileSize);
+            texWidth = tilesX * tileSize;
+            texHeight = Math.ceil(frameHeight / tileSize) * tileSize;
+        }
+
+        gl.bindTexture(gl.TEXTURE_2D, texture);
+        gl.texImage2D(
+            gl.TEXTURE_2D,
+            0,
+            gl.RGBA,
+            texWidth,
+            texHeight,
+            0,
+            gl.RGBA,
+            gl.UNSIGNED_BYTE,
+            null
+        );
+
+        const u = frameWidth / texWidth;
+        const v = frameHeight / texHeight;
+        gl.bindBuffer(gl.ARRAY_BUFFER, texCoordBuffer);
+        gl.bufferData(gl.ARRAY_BUFFER, new Float32Array([
+            0, v,
+            u, v,
+            0, 0,
+            u, 0,
+        ]), gl.STATIC_DRAW);
+        haveKeyframe = false;
+    }
+
+    function uploadFullFrame(pixels) {
+        if (pixels.length !== frameWidth * frameHeight * 4) {
+            console.warn("Unexpected pixel data length:", pixels.length);
+            return false;
+        }
+        gl.texSubImage2D(
+            gl.TEXTURE_2D, 0, 0, 0, frameWidth, frameHeight,
+            gl.RGBA, gl.UNSIGNED_BYTE, pixels
+        );
+        return true;
+    }
+
+    function applyDelta(buffer) {
+        const view = new DataView(buffer);
+        const count = view.getUint32(4, true);
+        const flags = view.getUint16(10, true);
+
+        if (flags & DELTA_FLAG_KEYFRAME) {
+            haveKeyframe = uploadFullFrame(new Uint8Array(buffer, DELTA_HEADER_BYTES));
+            return haveKeyframe;
+        }
+        if (!haveKeyframe) {
+            return false;
+        }
+
+        const indices = new Uint32Array(buffer, DELTA_HEADER_BYTES, count);
+        const tileBytes = tileSize * tileSize * 4;
+        let offset = DELTA_HEADER_BYTES + count * 4;
+        for (let i = 0; i < count; i++) {
+            const index = indices[i];
+            const x = (index % tilesX) * tileSize;
+            const y = Math.floor(index / tilesX) * tileSize;
+            gl.texSubImage2D(
+                gl.TEXTURE_2D, 0, x, y, tileSize, tileSize,
+                gl.RGBA, gl.UNSIGNED_BYTE,
+                new Uint8Array(buffer, offset, tileBytes)
+            );
+            offset += tileBytes;
+        }
+        return true;
+    }
+
+    ws.onopen = () => {
+        console.log("WebSocket connected, waiting for frames...");
+    };
+
+    ws.onclose = () => {
+        console.log("WebSocket disconnected. Refresh to reconnect.");
+    };
+
+    ws.onerror = (e) => {
+        console.error("WebSocket error:", e);
+    };
+
+    ws.onmessage = (event) => {
+        if (typeof event.data === "string") {
+            try {
+                const msg = JSON.parse(event.data);
+                if (msg.type === "init") {
+                    frameWidth = msg.width;
+                    frameHeight = msg.height;
+                    codec = msg.codec || "raw";
+                    tileSize = msg.tile_size || 0;
+                    gl.uniform1i(swapRBLocation, msg.pixel_format === "bgra" ? 1 : 0);
+                    console.log(`Streaming ${frameWidth}x${frameHeight} (${codec})`);
+                    initialized = true;
+                    setupTexture();
+                    resizeCanvasToDisplaySize();
+                } else if (msg.type === "error") {
+                    console.error("Server error:", msg.message);
+                }
+            } catch (err) {
+                console.error("Failed to parse JSON message:", err);
+            }
+            return;
+        }
+
+        if (!initialized) return;
+
+        if (codec === "raw" || codec === "delta") {
+            gl.bindTexture(gl.TEXTURE_2D, texture);
+            gl.pixelStorei(gl.UNPACK_ALIGNMENT, 1);
+            const updated = (codec === "delta")
+                ? applyDelta(event.data)
+                : uploadFullFrame(new Uint8Array(event.data));
+            if (updated) draw();
+            return;
+        }
+
+        // Compressed codecs decode asynchronously; while one decode is in
+        // flight only the newest pending frame is kept.
+        pendingFrame = event.data;
+        if (!decoding) {
+            decodePending();
+        }
+    };
+
+    let pendingFrame = null;
+    let decoding = false;
+
+    async function decodeFrame(buffer) {
+        if (IMAGE_TYPES[codec]) {
+            const bitmap = await createImageBitmap(new Blob([buffer], { type: IMAGE_TYPES[codec] }));
+            gl.bindTexture(gl.TEXTURE_2D, texture);
+            gl.texSubImage2D(gl.TEXTURE_2D, 0, 0, 0, gl.RGBA, gl.UNSIGNED_BYTE, bitmap);
+            bitmap.close();
+            return true;
+        }
+        if (codec === "zlib") {
+            const stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream("deflate"));
+            const pixels = new Uint8Array(await new Response(stream).arrayBuffer());
+            gl.bindTexture(gl.TEXTURE_2D, texture);
+            gl.pixelStorei(gl.UNPACK_ALIGNMENT, 1);
+            return uploadFullFrame(pixels);
+        }
+        console.warn("No browser decoder for codec:", codec);
+        return false;
+    }
+
+    async function decodePending() {
+        decoding = true;
+        try {
+            while (pendingFrame !== null) {
+                const buffer = pendingFrame;
+                pendingFrame = null;
+                if (await decodeFrame(buffer)) draw();
+            }
+        } catch (err) {
+            console.error("Failed to decode frame:", err);
+        } finally {
+            decoding = false;
+        }
+    }
+
+    function draw() {
+        resizeCanvasToDisplaySize();
+        gl.viewport(0, 0, canvas.width, canvas.height);
+        gl.clearColor(0.0, 0.0, 0.0, 1.0);
+        gl.clear(gl.COLOR_BUFFER_BIT);
+        gl.drawArrays(gl.TRIANGLE_STRIP, 0, 4);
+    }
+
+    resizeCanvasToDisplaySize();
+})();
+</script>
+</body>
+</html>
+"""
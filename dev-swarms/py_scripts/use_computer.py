@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
 import argparse
+import getpass
 import json
 import sys
 import os
+import signal
+import socket
+import socketserver
+import stat
 import tempfile
-import uuid
+import threading
 import time
 import base64
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from typing import Dict, Any, List
 
+import mss
+import numpy as np
 import pyautogui
 import screeninfo
 from PIL import Image
@@ -19,7 +30,73 @@ from PIL import Image
 # Let's keep it enabled but handle the FailSafeException if it happens.
 # pyautogui.FAILSAFE = True
 
-def get_screen_info() -> Dict[str, Any]:
+
+def _default_socket_path() -> str:
+    """
+    Per-user socket for --daemon: the session's private runtime directory
+    if there is one, else the temp dir with the user in the name.
+    use_computer_client.py picks the same path.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, "use_computer.sock")
+    user = os.getuid() if hasattr(os, "getuid") else getpass.getuser()
+    return os.path.join(tempfile.gettempdir(), f"use_computer-{user}.sock")
+
+
+SOCKET_PATH = _default_socket_path()
+# How long the daemon reuses the monitor topology before asking the OS again.
+SCREEN_INFO_TTL = 5.0
+
+# Screenshots are stored under a hash of their pixels and encoding options;
+# the least recently used files go once the directory exceeds either limit.
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "use_computer_cache")
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_MAX_AGE = 3600.0
+
+_screen_info_cache = None  # (timestamp, result), only reused by the daemon
+_daemon_mode = False
+# pyautogui and mss handles are not thread-safe, so socket connections hand
+# their commands to this single thread.
+_command_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="command")
+_mss_local = threading.local()
+_last_capture = None  # (RGB image, screen region) of the latest screenshot or locate grab
+
+# locate: templates keep their grayscale pyramid between calls, keyed by
+# path and mtime. The coarsest level keeps at least LOCATE_MIN_SIDE pixels
+# on the template's short side. Halving makes coarse scores depend on the
+# match's pixel phase, so the best LOCATE_CANDIDATES coarse peaks are all
+# refined instead of trusting a coarse threshold.
+LOCATE_MIN_SIDE = 8
+LOCATE_MAX_LEVELS = 4
+LOCATE_CANDIDATES = 32
+LOCATE_CACHE_ENTRIES = 32
+_template_cache = OrderedDict()
+_screen_pyramid = None  # (image, crop, levels, pyramid) so repeated "last" searches reuse it
+
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+RESAMPLE_FILTERS = {
+    "lanczos": Image.Resampling.LANCZOS,
+    "bicubic": Image.Resampling.BICUBIC,
+    "bilinear": Image.Resampling.BILINEAR,
+    "box": Image.Resampling.BOX,
+    "nearest": Image.Resampling.NEAREST,
+}
+
+
+def get_screen_info(params: Dict[str, Any] = None) -> Dict[str, Any]:
+    global _screen_info_cache
+    refresh = bool((params or {}).get("refresh"))
+    if _daemon_mode and _screen_info_cache and not refresh:
+        cached_at, cached = _screen_info_cache
+        if time.time() - cached_at < SCREEN_INFO_TTL:
+            return cached
+
     monitors = screeninfo.get_monitors()
     monitor_data = []
     for m in monitors:
@@ -35,53 +112,230 @@ def get_screen_info() -> Dict[str, Any]:
     # Also get primary screen size from pyautogui as a fallback/confirmation
     width, height = pyautogui.size()
     
-    return {
+    result = {
         "monitors": monitor_data,
         "primary_size": {"width": width, "height": height},
         "count": len(monitors)
     }
+    _screen_info_cache = (time.time(), result)
+    return result
+
+def _mss_handle():
+    """Per-thread mss handle, kept open so the daemon pays setup once."""
+    sct = getattr(_mss_local, "sct", None)
+    if sct is None:
+        sct = _mss_local.sct = mss.mss()
+    return sct
+
+
+def _capture_region(bbox) -> Dict[str, int]:
+    if bbox:
+        return {"left": bbox[0], "top": bbox[1], "width": bbox[2], "height": bbox[3]}
+    monitors = _mss_handle().monitors
+    monitor = monitors[1] if len(monitors) > 1 else monitors[0]
+    return {key: monitor[key] for key in ("left", "top", "width", "height")}
+
+
+def _grab_mss(bbox):
+    shot = _mss_handle().grab(_capture_region(bbox))
+    # BGRX unpacks the capture buffer straight into RGB without a swizzle pass.
+    # shot.raw is the grab's own bytearray; shot.bgra would copy it each read.
+    raw = shot.raw
+    return Image.frombuffer("RGB", shot.size, raw, "raw", "BGRX", 0, 1), raw
+
+
+def _grab_pixels(bbox=None) -> np.ndarray:
+    """One grab as a (height, width, 4) BGRA array over the capture buffer."""
+    img, raw = _grab_mss(bbox)
+    return np.frombuffer(raw, dtype=np.uint8).reshape(img.height, img.width, 4)
+
+
+def _cache_lookup(filepath: str) -> bool:
+    """True if the file is cached; a hit refreshes its mtime, which is the LRU clock."""
+    try:
+        os.utime(filepath)
+        return True
+    except OSError:
+        return False
+
+
+def _cache_store(filepath: str, data: bytes):
+    # Write-then-rename so a concurrent reader never sees a partial file.
+    tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, filepath)
+    _cache_evict(keep=filepath)
+
+
+def _cache_evict(keep: str):
+    entries = []
+    now = time.time()
+    with os.scandir(CACHE_DIR) as it:
+        for entry in it:
+            if not entry.name.startswith("use_computer_") or entry.name.endswith(".tmp") or entry.path == keep:
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if total <= CACHE_MAX_BYTES and now - mtime <= CACHE_MAX_AGE:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def _swap_last_pixel_hash(pixel_hash: str) -> bool:
+    """Record this capture's pixel hash; True if the previous capture had the same one."""
+    marker = os.path.join(CACHE_DIR, "last_pixels")
+    try:
+        with open(marker) as f:
+            previous = f.read().strip()
+    except OSError:
+        previous = None
+    if previous != pixel_hash:
+        with open(marker, "w") as f:
+            f.write(pixel_hash)
+    return previous == pixel_hash
+
 
 def get_screenshot(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Capture the primary screen or `bbox`, optionally scale it, and encode it.
+
+    Options: `format` png (default), jpeg or webp; `quality` for jpeg/webp
+    (default 80); `compress_level` for png (0-9, default 1: fast, lossless
+    anyway); `resample` lanczos (default), bicubic, bilinear, box or nearest
+    ("box" is much cheaper for large downscales); `inline` returns the image
+    as base64 instead of writing a file; `backend` mss (default) or
+    pyautogui. Every stage is timed in `timings_ms`.
+
+    Files live in CACHE_DIR named by a hash of the captured pixels plus the
+    output options, so an unchanged screen reuses the existing file without
+    resizing or encoding (`cache_hit`). `matches_previous` tells whether the
+    pixels equal those of the previous screenshot.
+    """
     bbox = params.get("bbox") # [x, y, width, height]
     scale = params.get("scale", 1.0)
-    
-    region = None
-    if bbox and len(bbox) == 4:
-        region = (bbox[0], bbox[1], bbox[2], bbox[3])
-    
+    fmt = str(params.get("format", "png")).lower()
+    resample = str(params.get("resample", "lanczos")).lower()
+    backend = params.get("backend", "mss")
+
+    if fmt not in IMAGE_FORMATS:
+        return {"error": f"Unsupported format: {fmt} (use png, jpeg or webp)"}
+    if resample not in RESAMPLE_FILTERS:
+        return {"error": f"Unsupported resample: {resample} (use {', '.join(RESAMPLE_FILTERS)})"}
+    if not (bbox and len(bbox) == 4):
+        bbox = None
+
+    timings = {}
+    started = time.perf_counter()
+    mark = started
+
+    def lap(stage: str):
+        nonlocal mark
+        now = time.perf_counter()
+        timings[stage] = round((now - mark) * 1000, 2)
+        mark = now
+
     try:
-        # pyautogui.screenshot() returns a PIL Image
-        img = pyautogui.screenshot(region=region)
-        
+        if backend == "pyautogui":
+            # pyautogui.screenshot() returns a PIL Image
+            img = pyautogui.screenshot(region=tuple(bbox) if bbox else None)
+            raw = img.tobytes()
+        else:
+            img, raw = _grab_mss(bbox)
+        _remember_capture(img, bbox)
+        lap("capture")
+        original_width, original_height = img.width, img.height
+
+        pixel_hash = hashlib.blake2b(raw, digest_size=16)
+        pixel_hash.update(f"{img.width}x{img.height}".encode())
+        pixel_hash = pixel_hash.hexdigest()
+        out_size = img.size
         if scale != 1.0 and scale > 0:
-            new_width = int(img.width * scale)
-            new_height = int(img.height * scale)
-            img = img.resize((new_width, new_height), Image.LANCZOS)
-        
-        # Save to temp file
-        tmp_dir = tempfile.gettempdir()
-        filename = f"use_computer_{uuid.uuid4()}.png"
-        filepath = os.path.join(tmp_dir, filename)
-        
-        img.save(filepath)
-        
-        return {
-            "filepath": filepath,
-            "width": img.width,
-            "height": img.height,
-            "original_width": int(img.width / scale) if scale != 1.0 else img.width,
-            "original_height": int(img.height / scale) if scale != 1.0 else img.height,
-            "scale": scale
+            out_size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        pil_format, mime_type = IMAGE_FORMATS[fmt]
+        if pil_format == "PNG":
+            save_options = {"compress_level": int(params.get("compress_level", 1))}
+        else:
+            save_options = {"quality": int(params.get("quality", 80))}
+        variant = hashlib.blake2b(
+            repr((out_size, resample, pil_format, sorted(save_options.items()))).encode(), digest_size=4
+        ).hexdigest()
+        ext = "jpg" if pil_format == "JPEG" else pil_format.lower()
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        filepath = os.path.join(CACHE_DIR, f"use_computer_{pixel_hash}_{variant}.{ext}")
+        matches_previous = _swap_last_pixel_hash(pixel_hash)
+        cache_hit = _cache_lookup(filepath)
+        lap("hash")
+
+        if cache_hit:
+            data = None
+        else:
+            if out_size != img.size:
+                img = img.resize(out_size, RESAMPLE_FILTERS[resample])
+                lap("resize")
+            out = BytesIO()
+            img.save(out, format=pil_format, **save_options)
+            data = out.getvalue()
+            lap("encode")
+            _cache_store(filepath, data)
+            lap("write")
+
+        result = {
+            "width": out_size[0],
+            "height": out_size[1],
+            "original_width": original_width,
+            "original_height": original_height,
+            "scale": scale,
+            "format": pil_format.lower(),
+            "bytes": len(data) if data is not None else os.path.getsize(filepath),
+            "cache_hit": cache_hit,
+            "matches_previous": matches_previous,
+            "pixel_hash": pixel_hash,
         }
+        if params.get("inline"):
+            if data is None:
+                with open(filepath, "rb") as f:
+                    data = f.read()
+            result["mime_type"] = mime_type
+            result["base64"] = base64.b64encode(data).decode("ascii")
+            lap("base64")
+        else:
+            result["filepath"] = filepath
+
+        timings["total"] = round((time.perf_counter() - started) * 1000, 2)
+        result["timings_ms"] = timings
+        return result
     except Exception as e:
         return {"error": str(e)}
 
 def perform_actions(params: Dict[str, Any]) -> Dict[str, Any]:
     actions = params.get("actions", [])
     results = []
+    baseline = None
+    baseline_error = None
     
-    for action in actions:
+    for index, action in enumerate(actions):
         action_type = action.get("type")
+        action_started = time.perf_counter()
+        # A wait_for_change right after an action compares against the screen
+        # from just before that action, so a fast UI reaction is not missed.
+        # A failed grab does not stop the action; the wait step reports it.
+        following = actions[index + 1] if index + 1 < len(actions) else {}
+        if following.get("type") == "wait_for_change" and action_type not in WAIT_ACTIONS:
+            try:
+                baseline = _grab_pixels(following.get("bbox"))
+            except Exception as e:
+                baseline_error = f"baseline capture failed: {e}"
         try:
             if action_type == "mouse_move":
                 x = action.get("x")
@@ -125,6 +379,17 @@ def perform_actions(params: Dict[str, Any]) -> Dict[str, Any]:
                 duration = action.get("duration", 1.0)
                 time.sleep(duration)
                 results.append({"type": action_type, "status": "success"})
+
+            elif action_type in WAIT_ACTIONS:
+                if action_type == "wait_for_change":
+                    error, baseline_error = baseline_error, None
+                    if error is not None:
+                        raise RuntimeError(error)
+                    outcome = WAIT_ACTIONS[action_type](action, baseline)
+                    baseline = None
+                else:
+                    outcome = WAIT_ACTIONS[action_type](action)
+                results.append({"type": action_type, **outcome})
                 
             else:
                 results.append({"type": action_type, "status": "error", "message": "Unknown action type"})
@@ -133,30 +398,605 @@ def perform_actions(params: Dict[str, Any]) -> Dict[str, Any]:
              results.append({"type": action_type, "status": "error", "message": str(e)})
              # Stop processing further actions on error? Or continue? 
              # Let's continue but report error
+        results[-1]["duration_ms"] = round((time.perf_counter() - action_started) * 1000, 2)
     
     return {"results": results}
 
+
+def wait_until_stable(bbox=None, stable_for: float = 0.3, timeout: float = 5.0, interval: float = 0.05) -> Dict[str, Any]:
+    """
+    Poll the screen (or `bbox`) until its pixels stay identical for
+    `stable_for` seconds or `timeout` passes. Consecutive grabs are compared
+    byte for byte, which is exact and cheaper than hashing.
+    """
+    started = time.perf_counter()
+    _, previous = _grab_mss(bbox)
+    stable_since = started
+    polls = 1
+    while True:
+        now = time.perf_counter()
+        if now - stable_since >= stable_for or now - started >= timeout:
+            break
+        time.sleep(max(0.0, min(interval, stable_for - (now - stable_since), timeout - (now - started))))
+        _, current = _grab_mss(bbox)
+        polls += 1
+        if current != previous:
+            previous = current
+            stable_since = time.perf_counter()
+    now = time.perf_counter()
+    return {
+        "stable": now - stable_since >= stable_for,
+        "waited_ms": round((now - started) * 1000, 2),
+        "polls": polls,
+    }
+
+
+def _poll_until(check, timeout: float, interval: float) -> Dict[str, Any]:
+    """Call check() until it returns True or `timeout` passes; report the wait."""
+    started = time.perf_counter()
+    polls = 0
+    while True:
+        polls += 1
+        matched = check()
+        elapsed = time.perf_counter() - started
+        if matched or elapsed >= timeout:
+            return {
+                "status": "success" if matched else "timeout",
+                "waited_ms": round(elapsed * 1000, 2),
+                "polls": polls,
+            }
+        time.sleep(min(interval, timeout - elapsed))
+
+
+def _differs(a: np.ndarray, b: np.ndarray, tolerance: int) -> np.ndarray:
+    """Per-pixel mask of colour channels differing by more than `tolerance`."""
+    if tolerance <= 0:
+        # Whole BGRA pixels as little-endian uint32 words; the mask drops the
+        # alpha byte, which mss does not guarantee to be valid.
+        return ((a.view("<u4")[..., 0] ^ b.view("<u4")[..., 0]) & 0x00FFFFFF) != 0
+    # max - min stays in uint8, so no widening copy is needed.
+    delta = np.maximum(a[..., :3], b[..., :3]) - np.minimum(a[..., :3], b[..., :3])
+    return delta.max(axis=-1) > tolerance
+
+
+def wait_for_change(action: Dict[str, Any], baseline: np.ndarray = None) -> Dict[str, Any]:
+    """
+    Wait until more than `threshold` (fraction, default 0 = any pixel) of
+    `bbox` differs from the baseline by more than `tolerance` per channel.
+    """
+    bbox = action.get("bbox")
+    tolerance = int(action.get("tolerance", 0))
+    threshold = float(action.get("threshold", 0.0))
+    if baseline is None:
+        baseline = _grab_pixels(bbox)
+    state = {"changed": 0.0}
+
+    def check() -> bool:
+        current = _grab_pixels(bbox)
+        if current.shape != baseline.shape:
+            state["changed"] = 1.0
+        else:
+            state["changed"] = float(_differs(current, baseline, tolerance).mean())
+        return state["changed"] > threshold
+
+    outcome = _poll_until(check, float(action.get("timeout", 5.0)), float(action.get("interval", 0.02)))
+    outcome["changed_fraction"] = round(state["changed"], 6)
+    return outcome
+
+
+def wait_for_stable(action: Dict[str, Any]) -> Dict[str, Any]:
+    """Wait until `bbox` stays unchanged for `stable_for` seconds."""
+    outcome = wait_until_stable(
+        bbox=action.get("bbox"),
+        stable_for=float(action.get("stable_for", 0.3)),
+        timeout=float(action.get("timeout", 5.0)),
+        interval=float(action.get("interval", 0.02)),
+    )
+    return {"status": "success" if outcome.pop("stable") else "timeout", **outcome}
+
+
+def wait_for_pixel(action: Dict[str, Any]) -> Dict[str, Any]:
+    """Wait until the pixel at (x, y) is within `tolerance` of `color` [r, g, b]."""
+    if action.get("x") is None or action.get("y") is None:
+        return {"status": "error", "error": "wait_for_pixel requires x and y"}
+    if not isinstance(action.get("color"), (list, tuple)) or len(action["color"]) < 3:
+        return {"status": "error", "error": "wait_for_pixel requires color [r, g, b]"}
+    x, y = int(action["x"]), int(action["y"])
+    target = np.array(action["color"][:3], dtype=np.int16)
+    tolerance = int(action.get("tolerance", 0))
+    state = {"color": None}
+
+    def check() -> bool:
+        bgra = _grab_pixels([x, y, 1, 1])[0, 0]
+        rgb = bgra[2::-1].astype(np.int16)
+        state["color"] = rgb.tolist()
+        return bool(np.abs(rgb - target).max() <= tolerance)
+
+    outcome = _poll_until(check, float(action.get("timeout", 5.0)), float(action.get("interval", 0.02)))
+    outcome["color"] = state["color"]
+    return outcome
+
+
+def wait_for_region_match(action: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Wait until `bbox` looks like the reference `image` (a file path, scaled
+    to the captured size if it differs, e.g. on HiDPI screens): at least
+    `min_match` (default 0.99) of its pixels within `tolerance` (default 8)
+    per channel.
+    """
+    bbox = action.get("bbox")
+    if not isinstance(bbox, (list, tuple)) or len(bbox) != 4:
+        return {"status": "error", "error": "wait_for_region_match requires bbox [x, y, w, h]"}
+    if not action.get("image"):
+        return {"status": "error", "error": "wait_for_region_match requires image (path to the reference)"}
+    height, width = _grab_pixels(bbox).shape[:2]
+    with Image.open(action["image"]) as ref:
+        ref = ref.convert("RGB")
+        if ref.size != (width, height):
+            ref = ref.resize((width, height), Image.Resampling.BOX)
+        reference = np.empty((ref.height, ref.width, 4), dtype=np.uint8)
+        reference[..., 2::-1] = np.asarray(ref)  # RGB into BGRA order
+    reference[..., 3] = 255
+    tolerance = int(action.get("tolerance", 8))
+    min_match = float(action.get("min_match", 0.99))
+    state = {"match": 0.0}
+
+    def check() -> bool:
+        current = _grab_pixels(bbox)
+        if current.shape != reference.shape:
+            return False
+        state["match"] = 1.0 - float(_differs(current, reference, tolerance).mean())
+        return state["match"] >= min_match
+
+    outcome = _poll_until(check, float(action.get("timeout", 5.0)), float(action.get("interval", 0.02)))
+    outcome["match_fraction"] = round(state["match"], 6)
+    return outcome
+
+
+WAIT_ACTIONS = {
+    "wait_for_change": wait_for_change,
+    "wait_for_stable": wait_for_stable,
+    "wait_for_pixel": wait_for_pixel,
+    "wait_for_region_match": wait_for_region_match,
+}
+
+
+def _remember_capture(img: Image.Image, bbox):
+    global _last_capture
+    _last_capture = (img, _capture_region(bbox))
+
+
+def _gray_pyramid(img: Image.Image, levels: int) -> List[np.ndarray]:
+    """
+    Grayscale float32 pyramid, each level half the previous. PIL's bilinear
+    downscale widens its triangle filter with the ratio, so every halving
+    is low-pass filtered in the same pass; that keeps coarse scores far
+    less sensitive to the match's pixel phase than a plain 2x2 average.
+    """
+    gray = img.convert("L")
+    pyramid = [np.asarray(gray, dtype=np.float32)]
+    for _ in range(levels - 1):
+        gray = gray.resize((max(1, gray.width // 2), max(1, gray.height // 2)), Image.Resampling.BILINEAR)
+        pyramid.append(np.asarray(gray, dtype=np.float32))
+    return pyramid
+
+
+def _template_pyramid(path: str):
+    """Cached (levels, [(zero-mean template, its norm)] per level) for an image file."""
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    cached = _template_cache.get(key)
+    if cached is not None:
+        _template_cache.move_to_end(key)
+        return cached, True
+    with Image.open(path) as template:
+        template = template.convert("RGB")
+        short_side = min(template.size)
+        levels = 1
+        while levels < LOCATE_MAX_LEVELS and short_side >> levels >= LOCATE_MIN_SIDE:
+            levels += 1
+        pyramid = []
+        for level in _gray_pyramid(template, levels):
+            centered = level - level.mean()
+            pyramid.append((centered, float(np.sqrt((centered * centered).sum()))))
+    _template_cache[key] = pyramid
+    while len(_template_cache) > LOCATE_CACHE_ENTRIES:
+        _template_cache.popitem(last=False)
+    return pyramid, False
+
+
+def _fft_size(n: int) -> int:
+    """Smallest 2^a * 3^b * 5^c >= n; FFTs of such sizes are several times faster."""
+    while True:
+        m = n
+        for factor in (2, 3, 5):
+            while m % factor == 0:
+                m //= factor
+        if m == 1:
+            return n
+        n += 1
+
+
+def _box_sums(image: np.ndarray, height: int, width: int) -> np.ndarray:
+    """Sum of every height x width window (valid positions) via an integral image."""
+    integral = np.zeros((image.shape[0] + 1, image.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(image, axis=0, dtype=np.float64), axis=1, out=integral[1:, 1:])
+    return (integral[height:, width:] - integral[:-height, width:]
+            - integral[height:, :-width] + integral[:-height, :-width])
+
+
+def _ncc_map(image: np.ndarray, template: np.ndarray, template_norm: float) -> np.ndarray:
+    """
+    Normalized cross-correlation of a zero-mean template at every valid
+    offset: the correlation runs as one FFT product, the per-window image
+    energy comes from integral images.
+    """
+    h, w = template.shape
+    fft_shape = (_fft_size(image.shape[0] + h - 1), _fft_size(image.shape[1] + w - 1))
+    spectrum = np.fft.rfft2(image, fft_shape) * np.fft.rfft2(template[::-1, ::-1], fft_shape)
+    numerator = np.fft.irfft2(spectrum, fft_shape)[h - 1:image.shape[0], w - 1:image.shape[1]]
+    sums = _box_sums(image, h, w)
+    energy = _box_sums(image * image, h, w) - sums * sums / (h * w)
+    denominator = np.sqrt(np.maximum(energy, 0.0)) * template_norm
+    # Flat windows give ~0/~0 plus FFT rounding noise; treat them as no match.
+    flat = energy < 1e-2 * h * w
+    return np.where(flat, 0.0, numerator / np.maximum(denominator, 1e-3))
+
+
+def _ncc_window(image: np.ndarray, template: np.ndarray, template_norm: float, x: int, y: int, radius: int):
+    """Best NCC score and offset within +-radius of (x, y), computed directly."""
+    h, w = template.shape
+    x0, y0 = max(0, x - radius), max(0, y - radius)
+    x1 = min(image.shape[1] - w, x + radius)
+    y1 = min(image.shape[0] - h, y + radius)
+    if x1 < x0 or y1 < y0:
+        return -1.0, x, y
+    patch = image[y0:y1 + h, x0:x1 + w]
+    windows = np.lib.stride_tricks.sliding_window_view(patch, (h, w))
+    numerator = np.einsum("abij,ij->ab", windows, template)
+    means = windows.mean(axis=(2, 3), keepdims=True)
+    energy = ((windows - means) ** 2).sum(axis=(2, 3))
+    denominator = np.sqrt(energy) * template_norm
+    # A flat window (or template) correlates with nothing.
+    scores = np.where(denominator > 1e-3, numerator / np.maximum(denominator, 1e-3), 0.0)
+    dy, dx = np.unravel_index(int(np.argmax(scores)), scores.shape)
+    return float(scores[dy, dx]), x0 + int(dx), y0 + int(dy)
+
+
+def _peaks(scores: np.ndarray, floor: float, limit: int, h: int, w: int) -> List[tuple]:
+    """Up to `limit` local maxima above `floor`, suppressing half a template around each."""
+    scores = scores.copy()
+    found = []
+    for _ in range(limit):
+        index = int(np.argmax(scores))
+        y, x = np.unravel_index(index, scores.shape)
+        if scores[y, x] < floor:
+            break
+        found.append((int(x), int(y)))
+        scores[max(0, y - h // 2):y + h // 2 + 1, max(0, x - w // 2):x + w // 2 + 1] = -1.0
+    return found
+
+
+def locate(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Find a reference `image` (file path) on screen with normalized
+    cross-correlation, coarse to fine. The full NCC map is computed only at
+    the coarsest pyramid level; each candidate is then refined within a
+    few pixels at every finer level. Options: `bbox` to search part of
+    the screen, `threshold` (default 0.9), `max_results` (default 5) and
+    `source` "grab" (default) or "last" to search the latest screenshot
+    instead of grabbing again. The template must be at screen resolution.
+    """
+    global _screen_pyramid
+    threshold = float(params.get("threshold", 0.9))
+    max_results = max(1, int(params.get("max_results", 5)))
+    bbox = params.get("bbox")
+    if not (bbox and len(bbox) == 4):
+        bbox = None
+
+    timings = {}
+    started = time.perf_counter()
+    mark = started
+
+    def lap(stage: str):
+        nonlocal mark
+        now = time.perf_counter()
+        timings[stage] = round((now - mark) * 1000, 2)
+        mark = now
+
+    try:
+        template_levels, template_cached = _template_pyramid(params["image"])
+        lap("template")
+
+        if params.get("source") == "last":
+            if _last_capture is None:
+                # Captures live in this process only: a one-shot run never has one.
+                return {"error": "No previous capture to search: source 'last' needs the daemon "
+                                 "(use_computer_client.py) and an earlier screenshot or locate"}
+            img, region = _last_capture
+            crop = None
+            if bbox:
+                # Crop the requested area out of the last capture, in its pixel scale.
+                sx, sy = img.width / region["width"], img.height / region["height"]
+                left = max(0, round((bbox[0] - region["left"]) * sx))
+                top = max(0, round((bbox[1] - region["top"]) * sy))
+                right = min(img.width, round((bbox[0] + bbox[2] - region["left"]) * sx))
+                bottom = min(img.height, round((bbox[1] + bbox[3] - region["top"]) * sy))
+                if right <= left or bottom <= top:
+                    return {"error": "bbox is outside the last capture"}
+                crop = (left, top, right, bottom)
+                region = {
+                    "left": region["left"] + left / sx,
+                    "top": region["top"] + top / sy,
+                    "width": (right - left) / sx,
+                    "height": (bottom - top) / sy,
+                }
+        else:
+            img, _ = _grab_mss(bbox)
+            region = _capture_region(bbox)
+            _remember_capture(img, bbox)
+            crop = None
+        lap("capture")
+
+        levels = len(template_levels)
+        cached = _screen_pyramid
+        if cached and cached[0] is img and cached[1] == crop and cached[2] == levels:
+            screen_levels = cached[3]
+        else:
+            screen_levels = _gray_pyramid(img.crop(crop) if crop else img, levels)
+            _screen_pyramid = (img, crop, levels, screen_levels)
+        lap("pyramid")
+
+        full_template, full_norm = template_levels[0]
+        if full_norm < 1e-3:
+            return {"error": "Reference image is a flat colour; there is nothing to match"}
+        if full_template.shape[0] > screen_levels[0].shape[0] or full_template.shape[1] > screen_levels[0].shape[1]:
+            return {"error": "Reference image is larger than the search area"}
+
+        # Coarse pass: full NCC map at the smallest level only.
+        coarse = len(template_levels) - 1
+        template, norm = template_levels[coarse]
+        scores = _ncc_map(screen_levels[coarse], template, norm)
+        floor = threshold if coarse == 0 else threshold * 0.5
+        candidates = _peaks(scores, floor, max(LOCATE_CANDIDATES, max_results * 4), *template.shape)
+        lap("coarse")
+
+        matches = []
+        for x, y in candidates:
+            score = float(scores[y, x])
+            for level in range(coarse - 1, -1, -1):
+                template, norm = template_levels[level]
+                score, x, y = _ncc_window(screen_levels[level], template, norm, x * 2, y * 2, 2)
+            if score >= threshold:
+                matches.append((score, x, y))
+        lap("refine")
+
+        h, w = full_template.shape
+        sx, sy = region["width"] / screen_levels[0].shape[1], region["height"] / screen_levels[0].shape[0]
+        results = []
+        for score, x, y in sorted(matches, reverse=True):
+            # Refined candidates can converge on the same spot.
+            if any(abs(x - px) < w // 2 and abs(y - py) < h // 2 for _, px, py in results):
+                continue
+            results.append((score, x, y))
+            if len(results) == max_results:
+                break
+
+        timings["total"] = round((time.perf_counter() - started) * 1000, 2)
+        return {
+            "matches": [
+                {
+                    "x": round(region["left"] + x * sx),
+                    "y": round(region["top"] + y * sy),
+                    "width": round(w * sx),
+                    "height": round(h * sy),
+                    "center": [round(region["left"] + (x + w / 2) * sx), round(region["top"] + (y + h / 2) * sy)],
+                    "score": round(score, 4),
+                }
+                for score, x, y in results
+            ],
+            "levels": len(template_levels),
+            "template_cached": template_cached,
+            "timings_ms": timings,
+        }
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def act_and_observe(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run an `input` action list, optionally wait for the screen to settle,
+    then take a screenshot, all in one command. `settle` is true or
+    {"stable_for": s, "timeout": s, "interval": s}; `screenshot` takes the
+    same options as the screenshot command (false skips it). The screenshot
+    is taken even if an action failed, so the caller can see what happened.
+    """
+    started = time.perf_counter()
+    timings = {}
+    result = {}
+
+    result["input"] = perform_actions(params)
+    timings["input"] = round((time.perf_counter() - started) * 1000, 2)
+
+    shot_params = params.get("screenshot", {})
+    if shot_params is True:
+        shot_params = {}
+    settle = params.get("settle")
+    if settle:
+        settle = settle if isinstance(settle, dict) else {}
+        mark = time.perf_counter()
+        try:
+            result["settle"] = wait_until_stable(
+                bbox=shot_params.get("bbox") if shot_params else None,
+                stable_for=float(settle.get("stable_for", 0.3)),
+                timeout=float(settle.get("timeout", 5.0)),
+                interval=float(settle.get("interval", 0.05)),
+            )
+        except Exception as e:
+            result["settle"] = {"error": str(e)}
+        timings["settle"] = round((time.perf_counter() - mark) * 1000, 2)
+
+    if shot_params is not False:
+        mark = time.perf_counter()
+        result["screenshot"] = get_screenshot(shot_params)
+        timings["screenshot"] = round((time.perf_counter() - mark) * 1000, 2)
+
+    timings["total"] = round((time.perf_counter() - started) * 1000, 2)
+    result["timings_ms"] = timings
+    return result
+
+def handle_command(input_data: Dict[str, Any]) -> Dict[str, Any]:
+    action = input_data.get("action")
+
+    if action == "screen_info":
+        return get_screen_info(input_data)
+    elif action == "screenshot":
+        return get_screenshot(input_data)
+    elif action == "input":
+        return perform_actions(input_data)
+    elif action == "act_and_observe":
+        return act_and_observe(input_data)
+    elif action == "locate":
+        return locate(input_data)
+    elif action == "ping" and _daemon_mode:
+        return {"status": "ok", "pid": os.getpid()}
+    elif action == "shutdown" and _daemon_mode:
+        return {"status": "shutting down"}
+    return {"error": f"Unknown action: {action}"}
+
+
+def handle_line(line: str) -> Dict[str, Any]:
+    """One line-delimited JSON request -> one response; an "id" is echoed back."""
+    try:
+        input_data = json.loads(line)
+    except json.JSONDecodeError:
+        return {"error": "Invalid JSON string"}
+    if not isinstance(input_data, dict):
+        return {"error": "Command must be a JSON object"}
+
+    try:
+        result = handle_command(input_data)
+    except Exception as e:
+        result = {"error": str(e)}
+    if "id" in input_data:
+        result["id"] = input_data["id"]
+    return result
+
+
+def serve_stdin():
+    """Answer JSON lines from stdin on stdout until EOF or a shutdown command."""
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        result = handle_line(line)
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+        if result.get("status") == "shutting down":
+            break
+
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for raw in self.rfile:
+            if not raw.strip():
+                continue
+            line = raw.decode("utf-8", errors="replace")
+            result = _command_executor.submit(handle_line, line).result()
+            self.wfile.write((json.dumps(result) + "\n").encode("utf-8"))
+            self.wfile.flush()
+            if result.get("status") == "shutting down":
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+
+
+class _CommandServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_socket(path: str):
+    """
+    Serve line-delimited JSON commands on a Unix socket until shutdown or a
+    signal. Only the current user can connect: the socket is created with
+    mode 0600, and a path that another user created is refused.
+    """
+    if os.path.lexists(path):
+        info = os.lstat(path)
+        if info.st_uid != os.getuid() or not stat.S_ISSOCK(info.st_mode):
+            print(f"[daemon] {path} is not a socket owned by this user; refusing to use it", file=sys.stderr)
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)  # stale socket from a daemon that died
+        else:
+            print(f"[daemon] already running on {path}", file=sys.stderr)
+            return
+        finally:
+            probe.close()
+
+    # Bind under a strict umask so the socket is never reachable by other users,
+    # not even between bind() and a later chmod().
+    old_umask = os.umask(0o077)
+    try:
+        server = _CommandServer(path, _CommandHandler)
+    finally:
+        os.umask(old_umask)
+
+    def _handle_signal(sig_num, _frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, _handle_signal)
+
+    print(f"[daemon] listening on {path} (pid {os.getpid()})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+        print("[daemon] stopped", file=sys.stderr)
+
+
 def main():
+    global _daemon_mode
     parser = argparse.ArgumentParser(description="Use Computer Skill Agent")
-    parser.add_argument("--json_str", type=str, required=True, help="JSON input string")
-    
+    parser.add_argument("--json_str", type=str, help="JSON input string")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Stay running and answer line-delimited JSON commands (stdin, or --socket).",
+    )
+    parser.add_argument(
+        "--socket",
+        nargs="?",
+        const=SOCKET_PATH,
+        default=None,
+        help=f"With --daemon, listen on this Unix socket instead of stdin (default: {SOCKET_PATH}).",
+    )
+
     args = parser.parse_args()
-    
+
+    if args.daemon:
+        _daemon_mode = True
+        try:
+            get_screen_info()  # warm the monitor topology before the first command
+        except Exception as e:
+            print(f"[daemon] screen info unavailable: {e}", file=sys.stderr)
+        if args.socket:
+            if not hasattr(socket, "AF_UNIX"):
+                parser.error("--socket needs Unix domain sockets; use stdin mode instead")
+            serve_socket(args.socket)
+        else:
+            serve_stdin()
+        return
+
+    if args.json_str is None:
+        parser.error("--json_str is required unless --daemon is given")
+
     try:
         input_data = json.loads(args.json_str)
-        action = input_data.get("action")
-        
-        result = {}
-        
-        if action == "screen_info":
-            result = get_screen_info()
-        elif action == "screenshot":
-            result = get_screenshot(input_data)
-        elif action == "input":
-            result = perform_actions(input_data)
-        else:
-            result = {"error": f"Unknown action: {action}"}
-            
+        result = handle_command(input_data)
         print(f"<output>{json.dumps(result)}</output>")
         
     except json.JSONDecodeError:
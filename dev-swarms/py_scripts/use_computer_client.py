@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Thin client for `use_computer.py --daemon --socket`.
+
+Takes the same --json_str commands and prints the same <output>{...}</output>
+result, but only imports the standard library: the daemon keeps pyautogui,
+screeninfo and PIL loaded. If no daemon is listening, one is started in
+the background on first use and reused by every later call. The socket is
+per user, and one owned by another user is never used.
+"""
+import argparse
+import getpass
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def _default_socket_path() -> str:
+    """Same per-user path as use_computer.py's default."""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, "use_computer.sock")
+    user = os.getuid() if hasattr(os, "getuid") else getpass.getuser()
+    return os.path.join(tempfile.gettempdir(), f"use_computer-{user}.sock")
+
+
+SOCKET_PATH = _default_socket_path()
+DAEMON_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "use_computer.py")
+START_TIMEOUT = 15.0
+
+
+def connect(path: str) -> socket.socket:
+    # Commands drive the mouse and keyboard and replies carry screenshots, so
+    # never talk to a daemon that another user could have started.
+    if os.stat(path).st_uid != os.getuid():
+        raise RuntimeError(f"{path} belongs to another user; pass --socket with a path of your own")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def start_daemon(path: str) -> socket.socket:
+    log_path = os.path.join(tempfile.gettempdir(), "use_computer_daemon.log")
+    with open(log_path, "ab") as log:
+        subprocess.Popen(
+            [sys.executable, DAEMON_SCRIPT, "--daemon", "--socket", path],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            start_new_session=True,
+        )
+    deadline = time.time() + START_TIMEOUT
+    while True:
+        try:
+            return connect(path)
+        except OSError:
+            if time.time() > deadline:
+                raise RuntimeError(f"use_computer daemon did not start, see {log_path}")
+            time.sleep(0.05)
+
+
+def send_command(command: str, path: str, autostart: bool = True) -> dict:
+    try:
+        sock = connect(path)
+    except OSError:
+        if not autostart:
+            raise RuntimeError(f"No use_computer daemon listening on {path}")
+        sock = start_daemon(path)
+    with sock, sock.makefile("rwb") as stream:
+        stream.write(command.encode("utf-8") + b"\n")
+        stream.flush()
+        reply = stream.readline()
+    if not reply:
+        raise RuntimeError("use_computer daemon closed the connection")
+    return json.loads(reply)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Use Computer Skill Agent (daemon client)")
+    parser.add_argument("--json_str", type=str, required=True, help="JSON input string")
+    parser.add_argument("--socket", type=str, default=SOCKET_PATH, help=f"Daemon socket (default: {SOCKET_PATH}).")
+    parser.add_argument("--no-start", action="store_true", help="Fail instead of starting a daemon.")
+    args = parser.parse_args()
+
+    # The command is a single line on the wire; re-serialize to drop newlines.
+    try:
+        command = json.dumps(json.loads(args.json_str))
+    except json.JSONDecodeError:
+        print(f"<output>{json.dumps({'error': 'Invalid JSON string'})}</output>")
+        return
+
+    try:
+        result = send_command(command, args.socket, autostart=not args.no_start)
+    except Exception as e:
+        result = {"error": str(e)}
+    print(f"<output>{json.dumps(result)}</output>")
+
+
+if __name__ == "__main__":
+    main()